@@ -0,0 +1,3 @@
+"""
+Shared helpers for the rule maps produced by `module_ko_to_rn` and `mapping`.
+"""
@@ -0,0 +1,138 @@
+"""
+Comparing two versions of rule maps (origin -> ID -> set of frozensets of KOs), e.g. two `rn2ko_map_by_type`
+outputs or two `calculated_module_dict` snapshots.
+
+Each (ID, ruleset) pair gets a 64 bit content hash of its sorted KO sets. The hashes of an origin are
+XORed into a fixed number of buckets (chosen by a hash of the ID), and the buckets into one hash per origin.
+Comparing two versions checks the origin hashes, then the buckets of the origins that differ, and only
+looks at the IDs of buckets that differ, so the work after hashing grows with the number of changes rather
+than the size of the maps.
+
+The report is a DataFrame with one row per changed ID and origin, sorted by origin and ID:
+    origin   map the ID is in
+    key      reaction (or module) ID
+    change   "added" (ID only in the new version), "removed" (only in the old one) or "changed"
+    added    KO sets only in the new version, as sorted "+"-joined KOs (as in kegg_rules.tables)
+    removed  KO sets only in the old version
+"""
+
+import os
+import sys
+import zlib
+import operator
+import functools
+import pickle
+import hashlib
+
+import pandas as pd
+
+DIFF_COLUMNS = ["origin", "key", "change", "added", "removed"]
+BUCKETS = 256
+
+def format_set(kos):
+    return "+".join(sorted(kos))
+
+def ruleset_hash(key, ruleset):
+    """64 bit hash of an ID and its ruleset; the same whatever the order of the sets and of their KOs"""
+    text = "%s\n%s" % (key, "\n".join(sorted(format_set(kos) for kos in ruleset)))
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+def bucket_of(key, buckets=BUCKETS):
+    return zlib.crc32(str(key).encode("utf-8")) % buckets
+
+class MapHashes:
+    """
+    Content hashes of rule maps, per ID, per bucket of IDs and per origin.
+
+    :param maps: dict of origin -> dict of ID -> set of frozensets of KOs; origins whose map is None are skipped
+    :param buckets: number of buckets per origin; both sides of a diff must use the same number
+    """
+
+    def __init__(self, maps, buckets=BUCKETS):
+        self.maps = {origin: rules for origin, rules in maps.items() if rules is not None}
+        self.n_buckets = buckets
+        self.keys = dict() ## origin -> list, per bucket, of dicts of ID -> hash
+        self.buckets = dict() ## origin -> list of bucket hashes
+        self.origins = dict() ## origin -> hash
+        for origin, rules in self.maps.items():
+            keys = [dict() for _ in range(buckets)]
+            hashes = [0] * buckets
+            for key, ruleset in rules.items():
+                b = bucket_of(key, buckets)
+                h = keys[b][key] = ruleset_hash(key, ruleset)
+                hashes[b] ^= h
+            self.keys[origin] = keys
+            self.buckets[origin] = hashes
+            self.origins[origin] = functools.reduce(operator.xor, hashes)
+
+def load_maps(path, origin=None):
+    """
+    Read rule maps from a pickle, a rule file (.rules) or a rule table (.csv/.parquet).
+
+    Pickles of a single map (`calculated_module_dict`, a combined map) are returned under `origin`,
+    by default the file name without its extension. Only unpickle files you made yourself.
+    """
+    if path.endswith(".rules"):
+        from kegg_rules.rulefile import RuleFile
+        with RuleFile(path) as rule_file:
+            return rule_file.to_maps()
+    if path.endswith(".csv") or path.endswith(".parquet"):
+        from kegg_rules.tables import read_rules_table
+        return read_rules_table(path)
+    with open(path, "rb") as f:
+        maps = pickle.load(f)
+    values = [v for v in maps.values() if v is not None]
+    if values and all(isinstance(v, dict) for v in values):
+        return maps
+    return {origin or os.path.splitext(os.path.basename(path))[0]: maps}
+
+def diff_maps(old, new):
+    """
+    Report of what changed between two versions of rule maps (see the module docstring).
+
+    :param old: maps (origin -> ID -> set of frozensets) or MapHashes of the old version
+    :param new: same, for the new version
+    :return: report DataFrame with DIFF_COLUMNS
+    """
+    old = old if isinstance(old, MapHashes) else MapHashes(old)
+    new = new if isinstance(new, MapHashes) else MapHashes(new, old.n_buckets)
+    if old.n_buckets != new.n_buckets:
+        raise ValueError("Can't compare hashes with %d and %d buckets" % (old.n_buckets, new.n_buckets))
+
+    rows = []
+    for origin in sorted(set(old.origins) | set(new.origins)):
+        old_rules, new_rules = old.maps.get(origin, {}), new.maps.get(origin, {})
+        if old.origins.get(origin) == new.origins.get(origin) and len(old_rules) == len(new_rules):
+            continue
+        old_buckets = old.buckets.get(origin, [0] * old.n_buckets)
+        new_buckets = new.buckets.get(origin, [0] * new.n_buckets)
+        changed = []
+        for b in range(old.n_buckets):
+            if old_buckets[b] == new_buckets[b]:
+                continue
+            old_keys = old.keys[origin][b] if origin in old.keys else {}
+            new_keys = new.keys[origin][b] if origin in new.keys else {}
+            changed += [key for key in old_keys.keys() | new_keys.keys() if old_keys.get(key) != new_keys.get(key)]
+        for key in sorted(changed, key=str):
+            old_sets, new_sets = old_rules.get(key), new_rules.get(key)
+            change = "added" if old_sets is None else "removed" if new_sets is None else "changed"
+            rows.append((origin, key, change,
+                         sorted(format_set(kos) for kos in (new_sets or set()) - (old_sets or set())),
+                         sorted(format_set(kos) for kos in (old_sets or set()) - (new_sets or set()))))
+    return pd.DataFrame(rows, columns=DIFF_COLUMNS)
+
+def summarize_diff(report):
+    """Number of added, removed and changed IDs per origin of a diff_maps report"""
+    counts = pd.crosstab(report["origin"], report["change"]) if len(report) else pd.DataFrame(index=pd.Index([], name="origin"))
+    return counts.reindex(columns=["added", "removed", "changed"], fill_value=0)
+
+def diff_files(old_path, new_path, origin=None):
+    """diff_maps of two files read with load_maps"""
+    return diff_maps(load_maps(old_path, origin), load_maps(new_path, origin))
+
+if __name__ == "__main__":
+    ## python -m kegg_rules.diff old.pkl new.rules [origin]   (from the repository root)
+    report = diff_files(*sys.argv[1:])
+    print(summarize_diff(report).to_string())
+    for row in report.itertuples(index=False):
+        print(row.origin, row.key, row.change, "+[%s]" % ", ".join(row.added), "-[%s]" % ", ".join(row.removed))
@@ -0,0 +1,261 @@
+"""
+Evaluating rule maps against many genomes at once with sparse matrices.
+
+A family map (ID -> set of frozensets of KOs, e.g. `calculated_module_dict`) is compiled into a
+sets x KO 0/1 matrix, with the sets of each ID in consecutive rows. A batch of genomes is a
+genome x KO 0/1 presence matrix, so `presence @ sets.T` counts, for every genome and set, how many
+of the set's KOs the genome has. The product stays sparse (only genome/set pairs sharing a KO are stored),
+and per-ID results are reductions of its entries over each ID's block of rows.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+import pandas as pd
+
+from .symbols import SymbolTable
+
+class KOSetMatrix:
+    """
+    KO sets of a family map as a sparse sets x KO matrix.
+
+    :param families: dict of ID -> iterable of frozensets of KOs. Every ID needs at least one set
+        (an empty frozenset is fine); an ID without any raises ValueError.
+    :param symbols: SymbolTable giving the KO columns; a new one is made if not given
+    :param ignore: tokens dropped from every set before compiling (they are treated as always present)
+    """
+
+    def __init__(self, families, symbols=None, ignore=()):
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        self.labels = [] ## IDs, in block order
+        self.sets = [] ## row -> frozenset, as given
+        starts = []
+        indptr, indices = [0], []
+        for label, sets in families.items():
+            sets = sorted(sets, key=sorted) ## Deterministic row order
+            if not sets:
+                raise ValueError("%s has no KO sets" % label)
+            self.labels.append(label)
+            starts.append(len(self.sets))
+            for fs in sets:
+                self.sets.append(fs)
+                indices.extend(sorted(self.symbols.encode(ko) for ko in fs if ko not in ignore))
+                indptr.append(len(indices))
+
+        self.starts = np.array(starts, dtype=np.int64) ## First row of each ID's block
+        self.owner = np.repeat(np.arange(len(self.labels)), np.diff(np.append(self.starts, len(self.sets)))) ## row -> block
+        self._set_matrix(indptr, indices)
+
+    def _set_matrix(self, indptr, indices):
+        self.matrix = sp.csr_matrix((np.ones(len(indices), dtype=np.float32), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+                                    shape=(len(self.sets), self.n_kos))
+        self.sizes = np.diff(self.matrix.indptr).astype(np.float32) ## KOs per set
+
+    @classmethod
+    def from_rulefile(cls, rules, origin=None, ignore=()):
+        """
+        Build straight from the arrays of a RuleFile (see kegg_rules.rulefile), without making Python sets.
+
+        KO columns follow the file's KO table. With origin=None every origin's terms are used (the combined map);
+        a term found in several origins gets a row for each, which doesn't change any result. Keys without terms
+        (in the selected origin) aren't part of the family.
+        """
+        self = cls.__new__(cls)
+        self.symbols = SymbolTable.from_names(ko.decode("utf-8") for ko in rules.kos)
+        rows = np.arange(len(rules.term_origin))
+        if origin is not None:
+            rows = rows[rules.term_origin == rules.origins.index(origin)]
+        term_key = np.searchsorted(rules.key_indptr, rows, side="right") - 1 ## Terms are grouped by key already
+        keys, starts = np.unique(term_key, return_index=True)
+        self.labels = [key.decode("utf-8") for key in rules.keys[keys]]
+        self.starts = starts.astype(np.int64)
+        self.owner = np.searchsorted(keys, term_key)
+        self.sets = RuleFileTerms(rules, rows)
+
+        ## Gather each selected term's slice of term_kos
+        lengths = (rules.term_indptr[rows + 1] - rules.term_indptr[rows]).astype(np.int64)
+        gather = np.repeat(rules.term_indptr[rows] - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        indices = rules.term_kos[gather]
+        term_of = np.repeat(np.arange(len(rows)), lengths)
+        if ignore:
+            keep = ~np.isin(indices, [self.symbols.ids["ko"][ko] for ko in ignore if ko in self.symbols.ids.get("ko", ())])
+            indices, term_of = indices[keep], term_of[keep]
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(term_of, minlength=len(rows)))])
+        self._set_matrix(indptr, indices)
+        return self
+
+    def __len__(self):
+        return len(self.sets)
+
+    @property
+    def n_kos(self):
+        return len(self.symbols.names.get("ko", []))
+
+    def presence(self, genomes):
+        """
+        Genome x KO presence matrix for a dict of genome -> iterable of KOs.
+        KOs not used by any set are ignored. Returns (genome IDs, csr matrix).
+        """
+        ko_ids = self.symbols.ids.get("ko", dict())
+        genome_ids = list(genomes)
+        indptr, indices = [0], []
+        for g in genome_ids:
+            indices.extend({ko_ids[ko] for ko in genomes[g] if ko in ko_ids})
+            indptr.append(len(indices))
+        matrix = sp.csr_matrix((np.ones(len(indices), dtype=np.float32), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+                               shape=(len(genome_ids), self.n_kos))
+        return genome_ids, matrix
+
+    def hits(self, presence):
+        """Sparse genome x set matrix of how many KOs of each set each genome has; zero counts aren't stored"""
+        presence = sp.csr_matrix(presence, dtype=np.float32)
+        if presence.shape[1] < self.n_kos: ## Symbol table grew after the presence matrix was built
+            presence.resize((presence.shape[0], self.n_kos))
+        return (presence @ self.matrix.T).tocsr()
+
+    def block_best(self, scores):
+        """
+        Max of a sparse genome x set matrix over each ID's block of sets, without densifying it.
+
+        Returns (maxima, rows): genome x ID maxima (0 for blocks without a stored entry) and the row of the
+        first set reaching each maximum (the block's first row where nothing is stored).
+        """
+        scores = sp.csr_matrix(scores)
+        scores.sort_indices()
+        maxima = np.zeros((scores.shape[0], len(self.labels)), dtype=scores.dtype)
+        rows = np.tile(self.starts, (scores.shape[0], 1))
+        if scores.nnz:
+            ## Within a genome, sorted set rows keep each block's entries together, so no sort is needed
+            genome = np.repeat(np.arange(scores.shape[0]), np.diff(scores.indptr))
+            block = self.owner[scores.indices]
+            key = genome * len(self.labels) + block
+            groups = np.flatnonzero(np.concatenate([[True], key[1:] != key[:-1]]))
+            best = np.maximum.reduceat(scores.data, groups)
+            candidates = np.where(scores.data == np.repeat(best, np.diff(np.append(groups, scores.nnz))), scores.indices, len(self.sets))
+            maxima[genome[groups], block[groups]] = best
+            rows[genome[groups], block[groups]] = np.minimum.reduceat(candidates, groups)
+        return maxima, rows
+
+class RuleFileTerms:
+    """Sequence of KO frozensets read from a RuleFile's terms on access, standing in for KOSetMatrix.sets"""
+
+    def __init__(self, rules, rows):
+        self.rules = rules
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return self.rules.term(self.rows[i])
+
+    def __iter__(self):
+        return (self.rules.term(row) for row in self.rows)
+
+class ModuleCompleteness:
+    """
+    Genome x module completeness from `calculated_module_dict`.
+
+    A module's completeness in a genome is the largest fraction of any one of its KO sets that the genome
+    has, so 1.0 means some set is fully present. The set reaching it is reported as the best match.
+
+    :param calculated_module_dict: dict of module ID -> set of frozensets of KOs
+    :param symbols: SymbolTable to number KOs with
+    """
+
+    def __init__(self, calculated_module_dict, symbols=None):
+        self.sets = KOSetMatrix(calculated_module_dict, symbols)
+        self.modules = self.sets.labels
+
+    @classmethod
+    def from_rulefile(cls, rules, origin=None):
+        """Engine over a RuleFile holding `calculated_module_dict` (e.g. assets/calculated_module_dict.rules)"""
+        self = cls.__new__(cls)
+        self.sets = KOSetMatrix.from_rulefile(rules, origin)
+        self.modules = self.sets.labels
+        return self
+
+    def evaluate(self, presence, batch_size=4096):
+        """
+        Evaluate a genome x KO presence matrix (see KOSetMatrix.presence), `batch_size` genomes at a time.
+
+        Returns (completeness, best): float32 genome x module fractions, and int genome x module rows
+        of the best matching set (look them up with `best_set`).
+        """
+        n = presence.shape[0]
+        completeness = np.empty((n, len(self.modules)), dtype=np.float32)
+        best = np.empty((n, len(self.modules)), dtype=np.int64)
+        ## Empty sets are complete with 0 hits, so never show up in the product; their blocks are fixed up after
+        empty = np.flatnonzero(self.sets.sizes == 0)
+        empty_blocks, first = np.unique(self.sets.owner[empty], return_index=True)
+        empty = empty[first]
+        for start in range(0, n, batch_size):
+            batch = slice(start, min(start + batch_size, n))
+            fractions = self.sets.hits(presence[batch])
+            fractions.data /= self.sets.sizes[fractions.indices]
+            completeness[batch], best[batch] = self.sets.block_best(fractions)
+            full = completeness[batch, empty_blocks] >= 1.0
+            best[batch, empty_blocks] = np.where(full, np.minimum(best[batch, empty_blocks], empty), empty)
+            completeness[batch, empty_blocks] = 1.0
+        return completeness, best
+
+    def best_set(self, row):
+        return self.sets.sets[row]
+
+    def evaluate_genomes(self, genomes, batch_size=4096):
+        """
+        Evaluate a dict of genome -> iterable of KOs.
+
+        Returns (completeness, best) as DataFrames indexed by genome with a column per module;
+        `best` holds the best matching KO frozensets.
+        """
+        genome_ids, presence = self.sets.presence(genomes)
+        completeness, best = self.evaluate(presence, batch_size)
+        best_sets = np.array(list(self.sets.sets) + [None], dtype=object)[best]
+        return (pd.DataFrame(completeness, index=genome_ids, columns=self.modules),
+                pd.DataFrame(best_sets, index=genome_ids, columns=self.modules))
+
+class ReactionFeasibility:
+    """
+    Genome x reaction feasibility from a combined reaction -> KO rule map (e.g. `rn2ko_map_combined.pkl`).
+
+    Each reaction's rules are an OR of ANDs: it is feasible in a genome that has every KO of at least one
+    of its frozensets. `"spontaneous"` always counts as present, so a rule of only `"spontaneous"` makes the
+    reaction feasible in every genome.
+
+    :param rn2ko_map: dict of reaction ID -> set of frozensets of KOs
+    :param symbols: SymbolTable to number KOs with
+    """
+    always_present = ("spontaneous",)
+
+    def __init__(self, rn2ko_map, symbols=None):
+        self.terms = KOSetMatrix(rn2ko_map, symbols, ignore=self.always_present)
+        self.reactions = self.terms.labels
+
+    @classmethod
+    def from_rulefile(cls, rules, origin=None):
+        """Engine over a RuleFile of reaction rules; all origins combined unless `origin` is given"""
+        self = cls.__new__(cls)
+        self.terms = KOSetMatrix.from_rulefile(rules, origin, ignore=cls.always_present)
+        self.reactions = self.terms.labels
+        return self
+
+    def evaluate(self, presence, batch_size=4096):
+        """
+        Evaluate a genome x KO presence matrix (see KOSetMatrix.presence), `batch_size` genomes at a time.
+
+        Returns a bool genome x reaction matrix.
+        """
+        n = presence.shape[0]
+        feasible = np.zeros((n, len(self.reactions)), dtype=bool)
+        feasible[:, self.terms.owner[self.terms.sizes == 0]] = True ## Terms of only always-present tokens
+        for start in range(0, n, batch_size):
+            hits = self.terms.hits(presence[start:start + batch_size])
+            genome = start + np.repeat(np.arange(hits.shape[0]), np.diff(hits.indptr))
+            satisfied = hits.data >= self.terms.sizes[hits.indices] ## Every KO of the term present
+            feasible[genome[satisfied], self.terms.owner[hits.indices[satisfied]]] = True
+        return feasible
+
+    def evaluate_genomes(self, genomes, batch_size=4096):
+        """Evaluate a dict of genome -> iterable of KOs, returning a bool DataFrame indexed by genome with a column per reaction"""
+        genome_ids, presence = self.terms.presence(genomes)
+        return pd.DataFrame(self.evaluate(presence, batch_size), index=genome_ids, columns=self.reactions)
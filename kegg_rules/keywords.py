@@ -0,0 +1,76 @@
+"""
+Tagging many texts with many keywords in one pass.
+
+The keywords are compiled into one regex, `(?=(longest|...|shortest))`, which is tried at every position
+of the text, so each text is read once whatever the number of keywords, and every occurrence is found,
+including overlapping ones (e.g. "pts" inside "ptsubunit" as well as "subunit"). At a given position only
+the longest matching keyword is reported; the shorter ones matching there are exactly its prefixes among
+the keywords, which are added back. Results are the same as a separate `keyword in text` test per keyword.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+SEPARATOR = "\0" ## Between texts in tag_all; can't be part of a match since no keyword contains it
+
+class KeywordTagger:
+    """
+    Finds which of a list of keywords occur in texts.
+
+    :param keywords: keywords to look for; also the column order of `tag_all`
+    :param case_sensitive: by default texts and keywords are compared lowercased
+    """
+
+    def __init__(self, keywords, case_sensitive=False):
+        self.keywords = list(keywords)
+        self.case_sensitive = case_sensitive
+        normalized = [self.normalize(k) for k in self.keywords]
+        if any(SEPARATOR in k or not k for k in normalized):
+            raise ValueError("Keywords must be non-empty and can't contain %r" % SEPARATOR)
+
+        ## Bitmask of a matched keyword and of the keywords that are its prefixes (duplicates included)
+        self.masks = dict()
+        for k in set(normalized):
+            self.masks[k] = sum(1 << i for i, other in enumerate(normalized) if k.startswith(other))
+        alternatives = sorted(self.masks, key=len, reverse=True)
+        self.pattern = re.compile("(?=(%s))" % "|".join(map(re.escape, alternatives)))
+
+    def normalize(self, text):
+        return text if self.case_sensitive else text.lower()
+
+    def tag(self, text):
+        """Bitmask of the keywords found in `text` (bit i = self.keywords[i])"""
+        masks = self.masks
+        found = 0
+        for keyword in set(self.pattern.findall(self.normalize(text))):
+            found |= masks[keyword]
+        return found
+
+    def keywords_in(self, text):
+        """List of the keywords found in `text`"""
+        found = self.tag(text)
+        return [keyword for i, keyword in enumerate(self.keywords) if found >> i & 1]
+
+    def tag_all(self, texts):
+        """
+        Bool DataFrame of which keywords occur in which texts, scanning them all as one string.
+
+        :param texts: dict of ID -> text
+        :return: DataFrame indexed by ID, one column per keyword
+        """
+        ids = list(texts)
+        table = np.zeros((len(ids), len(self.keywords)), dtype=bool)
+        corpus = self.normalize(SEPARATOR.join(texts[i] for i in ids))
+        ## Text of each match: the number of separators before it
+        separators = np.array([m.start() for m in re.finditer(SEPARATOR, corpus)], dtype=np.int64)
+        matches = [(m.start(), m.group(1)) for m in self.pattern.finditer(corpus)]
+        rows = np.searchsorted(separators, np.array([start for start, _ in matches], dtype=np.int64))
+        matched = np.array([keyword for _, keyword in matches], dtype=object)
+        for keyword, mask in self.masks.items():
+            hit = rows[matched == keyword]
+            for i in range(len(self.keywords)):
+                if mask >> i & 1:
+                    table[hit, i] = True
+        return pd.DataFrame(table, index=pd.Index(ids), columns=self.keywords)
@@ -0,0 +1,318 @@
+"""
+Flat, versioned binary files for rule maps (ID -> set of frozensets of KOs), read without unpickling.
+
+A file holds one or more rule maps, each under an "origin" name: the maps of `Mapping.maps` by type, a
+single combined map, `calculated_module_dict`, or `dict_of_local_r_to_k_rules` (one origin per module).
+Layout, all little-endian:
+
+    b"KEGGRULE"  uint32 version  uint32 header length  JSON header  (padding to 8 bytes)  arrays...
+
+The JSON header lists the origins and, for each array, its dtype, shape and byte offset. Arrays:
+
+    keys         S<n>   sorted, distinct key IDs (reactions or modules)
+    kos          S<n>   sorted, distinct KO IDs (string table; "spontaneous" is just another entry)
+    key_indptr   int32  terms of key i are rows key_indptr[i]:key_indptr[i+1], sorted by origin
+    key_origin_indptr, key_origins
+                 int32, int32  origins that have key i (even with no rules) are
+                               key_origins[key_origin_indptr[i]:key_origin_indptr[i+1]]
+    term_origin  int32  origin (index into header "origins") of each term
+    term_indptr  int32  KOs of term j are term_kos[term_indptr[j]:term_indptr[j+1]]
+    term_kos     int32  KO ids, sorted within each term
+
+Lookups binary search the `keys` table and only build Python sets for the terms they return.
+
+Since the arrays are used in place, a file can also be memory-mapped (`RuleFile(path, mmap=True)`) or
+copied once into shared memory (`share`) and attached by name from other processes (`RuleFile.attach`),
+so every worker reads the same physical pages instead of unpickling its own copy.
+"""
+
+import os
+import sys
+import json
+from mmap import mmap as memory_map, ACCESS_READ
+import struct
+import pickle
+from multiprocessing import shared_memory
+
+try:
+    import _posixshmem
+except ImportError: ## Windows, where SharedMemory isn't tracked
+    _posixshmem = None
+
+import numpy as np
+
+MAGIC = b"KEGGRULE"
+FORMAT_VERSION = 1
+ALIGN = 8
+
+def _padding(n):
+    return (-n) % ALIGN
+
+def _string_table(strings):
+    ## Fixed width bytes, so the table is one array that np.searchsorted can binary search
+    return np.array([s.encode("utf-8") for s in strings], dtype="S%d" % max([1] + [len(s.encode("utf-8")) for s in strings]))
+
+def write_rule_maps(OUTPATH, maps, meta=None):
+    """
+    Write rule maps to a rule file.
+
+    :param OUTPATH: path of the file to write
+    :param maps: dict of origin -> dict of ID -> set of frozensets of KOs; origins whose map is None are skipped
+    :param meta: optional JSON-serializable dict stored in the header (e.g. the KEGG snapshot date)
+    """
+    maps = {origin: rules for origin, rules in maps.items() if rules is not None}
+    origins = list(maps)
+    keys = sorted({key for rules in maps.values() for key in rules})
+    kos = sorted({ko for rules in maps.values() for ruleset in rules.values() for fs in ruleset for ko in fs})
+    ko_ids = {ko: i for i, ko in enumerate(kos)}
+
+    key_indptr, term_origin, term_indptr, term_kos = [0], [], [0], []
+    key_origin_indptr, key_origins = [0], []
+    for key in keys:
+        for o, origin in enumerate(origins):
+            if key in maps[origin]:
+                key_origins.append(o)
+            for term in sorted(sorted(ko_ids[ko] for ko in fs) for fs in maps[origin].get(key, ())):
+                term_origin.append(o)
+                term_kos.extend(term)
+                term_indptr.append(len(term_kos))
+        key_indptr.append(len(term_origin))
+        key_origin_indptr.append(len(key_origins))
+
+    arrays = {"keys": _string_table(keys),
+              "kos": _string_table(kos),
+              "key_indptr": np.array(key_indptr, dtype="<i4"),
+              "key_origin_indptr": np.array(key_origin_indptr, dtype="<i4"),
+              "key_origins": np.array(key_origins, dtype="<i4"),
+              "term_origin": np.array(term_origin, dtype="<i4"),
+              "term_indptr": np.array(term_indptr, dtype="<i4"),
+              "term_kos": np.array(term_kos, dtype="<i4")}
+
+    ## Offsets are relative to the start of the data section, so the header can be sized after
+    layout, offset = dict(), 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += array.nbytes + _padding(array.nbytes)
+    header = json.dumps({"origins": origins, "arrays": layout, "meta": meta or dict()}).encode("utf-8")
+
+    with open(OUTPATH, "wb") as f:
+        prefix = MAGIC + struct.pack("<II", FORMAT_VERSION, len(header)) + header
+        f.write(prefix + b"\0" * _padding(len(prefix)))
+        for array in arrays.values():
+            f.write(array.tobytes())
+            f.write(b"\0" * _padding(array.nbytes))
+
+def write_rule_map(OUTPATH, rules, origin="combined", meta=None):
+    """Write a single rule map (ID -> set of frozensets of KOs) to a rule file"""
+    write_rule_maps(OUTPATH, {origin: rules}, meta)
+
+def read_header(buffer):
+    """(version, header dict, start of the data section) of a rule file held in `buffer`"""
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a rule file (bad magic)")
+    version, header_len = struct.unpack("<II", bytes(buffer[len(MAGIC):len(MAGIC) + 8]))
+    if version > FORMAT_VERSION:
+        raise ValueError("Rule file version %d is newer than supported (%d)" % (version, FORMAT_VERSION))
+    start = len(MAGIC) + 8
+    header = json.loads(bytes(buffer[start:start + header_len]).decode("utf-8"))
+    data_start = start + header_len
+    return version, header, data_start + _padding(data_start)
+
+def share(path, name=None):
+    """
+    Copy a rule file into a new shared memory block, for workers to open with `RuleFile.attach(shm.name)`.
+
+    The caller owns the block: keep the returned SharedMemory alive while workers use it, then
+    `close()` and `unlink()` it.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    shm = shared_memory.SharedMemory(name=name, create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    return shm
+
+def _attach_untracked(name):
+    ## Attaching mustn't register the block with a resource tracker: one that isn't the creator's would
+    ## unlink it when this process exits (the creator owns it), and unregistering afterwards would drop
+    ## the creator's own registration when they share a tracker, as pool workers do.
+    ## SharedMemory takes track=False from Python 3.13; before that, map the block read-only ourselves.
+    ## Returns (SharedMemory or None, buffer)
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+        return shm, shm.buf
+    if _posixshmem is None:
+        shm = shared_memory.SharedMemory(name=name)
+        return shm, shm.buf
+    fd = _posixshmem.shm_open("/" + name, os.O_RDONLY, mode=0o600)
+    try:
+        return None, memory_map(fd, 0, access=ACCESS_READ)
+    finally:
+        os.close(fd)
+
+class RuleFile:
+    """
+    Read-only view of a rule file.
+
+    :param path: path to a file written by `write_rule_maps`
+    :param mmap: memory-map the file instead of reading it, so pages are loaded on use and shared
+        between processes mapping the same file
+    """
+
+    def __init__(self, path=None, mmap=False, buffer=None):
+        self._shm = None
+        self._mmap = None
+        if buffer is None:
+            with open(path, "rb") as f:
+                if mmap:
+                    self._mmap = memory_map(f.fileno(), 0, access=ACCESS_READ)
+                    buffer = self._mmap
+                else:
+                    buffer = f.read()
+        self._init_from_buffer(buffer)
+
+    @classmethod
+    def attach(cls, name):
+        """Open a rule file placed in shared memory by `share`, without copying it"""
+        shm, buffer = _attach_untracked(name)
+        rules = cls(buffer=buffer)
+        if shm is None:
+            rules._mmap = buffer
+        else:
+            rules._shm = shm
+        return rules
+
+    def close(self):
+        """Release a memory-mapped or shared memory buffer; the object can't be used afterwards"""
+        for name in self.header["arrays"]:
+            delattr(self, name)
+        self.buffer = None
+        if self._shm is not None:
+            self._shm.close()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _init_from_buffer(self, buffer):
+        self.buffer = buffer
+        self.version, self.header, data_start = read_header(buffer)
+        self.origins = self.header["origins"]
+        self.meta = self.header["meta"]
+        for name, spec in self.header["arrays"].items():
+            array = np.frombuffer(buffer, dtype=np.dtype(spec["dtype"]), count=int(np.prod(spec["shape"])),
+                                  offset=data_start + spec["offset"])
+            setattr(self, name, array.reshape(spec["shape"]))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.key_index(key) is not None
+
+    def __iter__(self):
+        return (key.decode("utf-8") for key in self.keys)
+
+    def key_index(self, key):
+        """Row of `key` in the keys table, or None"""
+        k = key.encode("utf-8")
+        i = int(np.searchsorted(self.keys, k))
+        if i < len(self.keys) and self.keys[i] == k:
+            return i
+        return None
+
+    def key_indices(self, keys):
+        """Rows of many keys at once, -1 for keys that aren't in the file"""
+        if not len(keys):
+            return np.zeros(0, dtype=np.int64)
+        k = np.array([key.encode("utf-8") for key in keys]) ## Own width, so longer keys aren't truncated into a match
+        i = np.searchsorted(self.keys, k)
+        found = i < len(self.keys)
+        found[found] = self.keys[i[found]] == k[found]
+        return np.where(found, i, -1)
+
+    def term_rows(self, key, origin=None):
+        """Term rows of `key`, optionally only those from `origin`"""
+        i = self.key_index(key)
+        if i is None:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.arange(self.key_indptr[i], self.key_indptr[i + 1])
+        if origin is not None:
+            rows = rows[self.term_origin[rows] == self.origins.index(origin)]
+        return rows
+
+    def term(self, row):
+        """KOs of one term as a frozenset"""
+        ids = self.term_kos[self.term_indptr[row]:self.term_indptr[row + 1]]
+        return frozenset(ko.decode("utf-8") for ko in self.kos[ids])
+
+    def get(self, key, origin=None, default=None):
+        """
+        Rules of `key` as a set of frozensets, from one origin or the union over all of them
+        (the same as the combined map). Returns `default` if the key isn't in the file (or origin).
+        """
+        if key not in self or (origin is not None and origin not in self.origins_of(key)):
+            return default
+        return {self.term(row) for row in self.term_rows(key, origin)}
+
+    def __getitem__(self, key):
+        rules = self.get(key)
+        if rules is None:
+            raise KeyError(key)
+        return rules
+
+    def origins_of(self, key):
+        """Names of the origins that have `key`"""
+        i = self.key_index(key)
+        if i is None:
+            return []
+        return [self.origins[o] for o in self.key_origins[self.key_origin_indptr[i]:self.key_origin_indptr[i + 1]]]
+
+    def to_dict(self, origin=None):
+        """Rebuild one origin's map (or the union of all) as ID -> set of frozensets"""
+        terms = [self.term(row) for row in range(len(self.term_origin))]
+        o = None if origin is None else self.origins.index(origin)
+        rules = dict()
+        for i, key in enumerate(self):
+            rows = range(self.key_indptr[i], self.key_indptr[i + 1])
+            if o is not None:
+                if o not in self.key_origins[self.key_origin_indptr[i]:self.key_origin_indptr[i + 1]]:
+                    continue
+                rows = [row for row in rows if self.term_origin[row] == o]
+            rules[key] = {terms[row] for row in rows}
+        return rules
+
+    def to_maps(self):
+        """Rebuild every origin's map, as passed to write_rule_maps, in one pass over the terms"""
+        terms = [self.term(row) for row in range(len(self.term_origin))]
+        key_indptr, term_origin = self.key_indptr.tolist(), self.term_origin.tolist()
+        key_origin_indptr, key_origins = self.key_origin_indptr.tolist(), self.key_origins.tolist()
+        maps = [dict() for _ in self.origins]
+        for i, key in enumerate(self):
+            for o in key_origins[key_origin_indptr[i]:key_origin_indptr[i + 1]]:
+                maps[o][key] = set()
+            for row in range(key_indptr[i], key_indptr[i + 1]):
+                maps[term_origin[row]][key].add(terms[row])
+        return dict(zip(self.origins, maps))
+
+def convert_pickle(path, OUTPATH, origin="combined"):
+    """
+    Convert a pickled rule map to a rule file. Handles both shapes the pipelines pickle:
+    ID -> set of frozensets (written under `origin`), and origin -> ID -> set of frozensets
+    (`Mapping` maps by type, `dict_of_local_r_to_k_rules`).
+    Only use on pickles you made yourself; unpickling runs arbitrary code.
+    """
+    with open(path, "rb") as f:
+        maps = pickle.load(f)
+    values = [v for v in maps.values() if v is not None]
+    if values and all(isinstance(v, dict) for v in values):
+        write_rule_maps(OUTPATH, maps)
+    else:
+        write_rule_map(OUTPATH, maps, origin)
+
+if __name__ == "__main__":
+    ## python rulefile.py rules.pkl rules.rules [origin]
+    convert_pickle(*sys.argv[1:])
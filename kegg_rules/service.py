@@ -0,0 +1,267 @@
+"""
+A small local HTTP service that loads the rule maps once and answers batched JSON queries.
+
+Served over TCP or a Unix socket with asyncio, speaking just enough HTTP/1.1 for keep-alive
+connections (requests need a Content-Length, no chunked bodies). All endpoints take a JSON POST body:
+
+    /rules        {"reactions": [...], "origin": null}  -> {"rules": {reaction: [[KO, ...], ...] or null}}
+    /modules      {"modules": [...]}                    -> {"modules": {module: [[KO, ...], ...] or null}}
+    /completeness {"genomes": {genome: [KO, ...]}}      -> {"completeness": {genome: {module: fraction}},
+                                                             "complete": {genome: [module, ...]}}
+    /feasibility  {"genomes": {genome: [KO, ...]}}      -> {"feasible": {genome: [reaction, ...]}}
+
+plus GET /health. Identical request bodies are answered from an LRU cache of encoded responses.
+Run with `python service.py [--port 8765 | --unix PATH]`, and query with `RuleClient`.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+import collections
+import http.client
+import socket
+
+import numpy as np
+
+if __name__ == "__main__":
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from kegg_rules.rulefile import RuleFile
+from kegg_rules.evaluate import ModuleCompleteness, ReactionFeasibility
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DEFAULT_REACTION_RULES = os.path.join(REPO, "mapping", "final_map", "v3", "rn2ko_map_by_type.rules")
+DEFAULT_MODULE_RULES = os.path.join(REPO, "module_ko_to_rn", "assets", "calculated_module_dict.rules")
+
+class LRUCache:
+    """Least recently used cache of at most `maxsize` entries"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+class RuleService:
+    """
+    Holds the rule files and evaluators, and answers requests.
+
+    :param reaction_rules: rule file of reaction -> KO rules (e.g. rn2ko_map_by_type.rules from Mapping)
+    :param module_rules: rule file of module -> KO sets (calculated_module_dict.rules from module_ko_to_rn)
+    :param cache_size: number of responses kept in the LRU cache, 0 to disable it
+    """
+
+    def __init__(self, reaction_rules=DEFAULT_REACTION_RULES, module_rules=DEFAULT_MODULE_RULES, cache_size=1024):
+        self.reaction_rules = RuleFile(reaction_rules, mmap=True)
+        self.module_rules = RuleFile(module_rules, mmap=True)
+        self.reactions = ReactionFeasibility.from_rulefile(self.reaction_rules)
+        self.modules = ModuleCompleteness.from_rulefile(self.module_rules)
+        self.cache = LRUCache(cache_size) if cache_size else None
+        self.routes = {"/rules": self.rules, "/modules": self.module_sets,
+                       "/completeness": self.completeness, "/feasibility": self.feasibility}
+
+    ##########################################
+    ## Endpoints; each takes the decoded request and returns a JSON-serializable dict
+    ##########################################
+    @staticmethod
+    def _sets(rules, key, origin=None):
+        ruleset = rules.get(key, origin)
+        return None if ruleset is None else sorted(sorted(fs) for fs in ruleset)
+
+    def rules(self, request):
+        origin = request.get("origin")
+        return {"rules": {r: self._sets(self.reaction_rules, r, origin) for r in request["reactions"]}}
+
+    def module_sets(self, request):
+        return {"modules": {m: self._sets(self.module_rules, m) for m in request["modules"]}}
+
+    def completeness(self, request):
+        genome_ids, presence = self.modules.sets.presence(request["genomes"])
+        completeness, _ = self.modules.evaluate(presence)
+        modules = np.array(self.modules.modules, dtype=object)
+        return {"completeness": {g: dict(zip(self.modules.modules, row.round(4).tolist())) for g, row in zip(genome_ids, completeness)},
+                "complete": {g: modules[row >= 1.0].tolist() for g, row in zip(genome_ids, completeness)}}
+
+    def feasibility(self, request):
+        genome_ids, presence = self.reactions.terms.presence(request["genomes"])
+        feasible = self.reactions.evaluate(presence)
+        reactions = np.array(self.reactions.reactions, dtype=object)
+        return {"feasible": {g: reactions[row].tolist() for g, row in zip(genome_ids, feasible)}}
+
+    def health(self):
+        return {"status": "ok", "reactions": len(self.reaction_rules), "modules": len(self.module_rules),
+                "cache": None if self.cache is None else {"size": len(self.cache.entries), "hits": self.cache.hits, "misses": self.cache.misses}}
+
+    ##########################################
+    ## HTTP
+    ##########################################
+    async def respond(self, method, path, body):
+        """(status, encoded JSON body) for one request"""
+        if method == "GET" and path == "/health":
+            return 200, json.dumps(self.health()).encode()
+        if method != "POST" or path not in self.routes:
+            return 404, json.dumps({"error": "unknown endpoint %s %s" % (method, path)}).encode()
+
+        key = (path, body)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return 200, cached
+        try:
+            request = json.loads(body)
+        except ValueError as e:
+            return 400, json.dumps({"error": "invalid JSON: %s" % e}).encode()
+        try:
+            ## Evaluations can take a while; keep the loop free for other connections
+            response = await asyncio.get_running_loop().run_in_executor(None, self.routes[path], request)
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            return 400, json.dumps({"error": "bad request: %r" % e}).encode()
+        except Exception as e:
+            return 500, json.dumps({"error": "internal error: %r" % e}).encode()
+        encoded = json.dumps(response).encode()
+        if self.cache is not None:
+            self.cache.put(key, encoded)
+        return 200, encoded
+
+    async def handle(self, reader, writer):
+        ## One connection; serves requests until the client closes it or asks to
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, path, version = request_line.decode("latin-1").split()
+                    length = int(headers.get("content-length", 0))
+                except ValueError:
+                    ## The rest of the stream can't be trusted after a malformed request; answer and close
+                    await self.send(writer, 400, json.dumps({"error": "malformed request"}).encode(), keep_alive=False)
+                    break
+                body = await reader.readexactly(length)
+
+                try:
+                    status, payload = await self.respond(method, path, body)
+                except Exception as e:
+                    status, payload = 500, json.dumps({"error": "internal error: %r" % e}).encode()
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                await self.send(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass ## Truncated body or client went away
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def send(writer, status, payload, keep_alive):
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n"
+                      % (status, http.client.responses.get(status, ""), len(payload), "keep-alive" if keep_alive else "close")).encode("latin-1"))
+        writer.write(payload)
+        await writer.drain()
+
+    async def start(self, host="127.0.0.1", port=8765, unix=None):
+        """Start listening on `unix` (a socket path) if given, otherwise on host:port. Returns the asyncio server"""
+        if unix is not None:
+            if os.path.exists(unix):
+                os.remove(unix)
+            return await asyncio.start_unix_server(self.handle, path=unix)
+        return await asyncio.start_server(self.handle, host, port)
+
+    def serve_forever(self, host="127.0.0.1", port=8765, unix=None):
+        async def run():
+            server = await self.start(host, port, unix)
+            async with server:
+                await server.serve_forever()
+        asyncio.run(run())
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+class RuleClient:
+    """
+    Client for RuleService, reusing one connection for all requests.
+
+    :param host: host of a TCP service
+    :param port: port of a TCP service
+    :param unix: path of a Unix socket service, used instead of host/port
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765, unix=None, timeout=60):
+        if unix is not None:
+            self.connection = UnixHTTPConnection(unix, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, path, payload=None):
+        if payload is None:
+            self.connection.request("GET", path)
+        else:
+            self.connection.request("POST", path, body=json.dumps(payload), headers={"Content-Type": "application/json"})
+        response = self.connection.getresponse()
+        data = json.loads(response.read())
+        if response.status != 200:
+            raise ValueError("%s failed (%d): %s" % (path, response.status, data.get("error")))
+        return data
+
+    def rules(self, reactions, origin=None):
+        """reaction -> set of frozensets of KOs (None for unknown reactions)"""
+        rules = self.request("/rules", {"reactions": list(reactions), "origin": origin})["rules"]
+        return {r: None if sets is None else {frozenset(fs) for fs in sets} for r, sets in rules.items()}
+
+    def module_sets(self, modules):
+        sets = self.request("/modules", {"modules": list(modules)})["modules"]
+        return {m: None if s is None else {frozenset(fs) for fs in s} for m, s in sets.items()}
+
+    def completeness(self, genomes):
+        """genome -> {module: completeness}, and genome -> complete modules, for a dict of genome -> KOs"""
+        response = self.request("/completeness", {"genomes": {g: sorted(kos) for g, kos in genomes.items()}})
+        return response["completeness"], response["complete"]
+
+    def feasibility(self, genomes):
+        """genome -> feasible reactions, for a dict of genome -> KOs"""
+        return self.request("/feasibility", {"genomes": {g: sorted(kos) for g, kos in genomes.items()}})["feasible"]
+
+    def health(self):
+        return self.request("/health")
+
+    def close(self):
+        self.connection.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve KEGG rule maps over local HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="serve on this Unix socket path instead of TCP")
+    parser.add_argument("--reaction-rules", default=DEFAULT_REACTION_RULES)
+    parser.add_argument("--module-rules", default=DEFAULT_MODULE_RULES)
+    parser.add_argument("--cache-size", type=int, default=1024)
+    args = parser.parse_args()
+    RuleService(args.reaction_rules, args.module_rules, args.cache_size).serve_forever(args.host, args.port, args.unix)
@@ -0,0 +1,143 @@
+"""
+Reading manually curated rule spreadsheets, with a report of the rows that were rejected or look wrong.
+
+Rules are parsed with a small grammar (whitespace is ignored):
+
+    rule   := term ("," term)*      any one of the terms (OR)
+    term   := factor ("+" factor)*  all of the factors (AND)
+    factor := KO | "(" rule ")"
+
+and expanded to disjunctive normal form, the set of frozensets of KOs used by the rule maps:
+"K1+(K2,K3)" -> {frozenset({"K1", "K2"}), frozenset({"K1", "K3"})}. KO strings are interned, so
+equal KOs in different rules are one object.
+
+Problem rows are collected in an issues DataFrame with columns
+    row       spreadsheet row (the header is row 1)
+    key       reaction ID of the row
+    rule      rule text of the row
+    issue     what is wrong
+    rejected  True if the row was left out of the rules, False if it was kept and only looks suspicious
+"""
+
+import re
+import sys
+
+import pandas as pd
+
+TOKENS = re.compile(r"[A-Za-z0-9_]+|\S")
+IDENTIFIER = re.compile(r"[A-Za-z0-9_]+$")
+FLAT_RULE = re.compile(r"\s*[A-Za-z0-9_]+\s*(?:[+,]\s*[A-Za-z0-9_]+\s*)*$") ## No parentheses; most curated rules
+KO_ID = re.compile(r"K\d{5}$")
+SPECIAL_KOS = ("spontaneous",)
+ISSUE_COLUMNS = ["row", "key", "rule", "issue", "rejected"]
+
+class RuleSyntaxError(ValueError):
+    pass
+
+def parse_rule(rule):
+    """Parse one rule (see the module docstring) into a set of frozensets of KOs"""
+    if FLAT_RULE.match(rule): ## Already in normal form
+        intern = sys.intern
+        return {frozenset(map(intern, term.split("+"))) for term in "".join(rule.split()).split(",")}
+    tokens = TOKENS.findall(rule)
+    if not tokens:
+        raise RuleSyntaxError("empty rule")
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def expect_factor():
+        nonlocal pos
+        token = peek()
+        if token == "(":
+            pos += 1
+            sets = expect_rule()
+            if peek() != ")":
+                raise RuleSyntaxError("missing ')' in %r" % rule)
+            pos += 1
+            return sets
+        if token is None or not IDENTIFIER.match(token):
+            raise RuleSyntaxError("expected a KO at %r in %r" % ("end" if token is None else token, rule))
+        pos += 1
+        return {frozenset([sys.intern(token)])}
+
+    def expect_term():
+        nonlocal pos
+        sets = expect_factor()
+        while peek() == "+":
+            pos += 1
+            factor = expect_factor()
+            sets = {a | b for a in sets for b in factor}
+        return sets
+
+    def expect_rule():
+        nonlocal pos
+        sets = expect_term()
+        while peek() == ",":
+            pos += 1
+            sets |= expect_term()
+        return sets
+
+    sets = expect_rule()
+    if pos != len(tokens):
+        raise RuleSyntaxError("unexpected %r in %r" % (tokens[pos], rule))
+    return sets
+
+def parse_rule_rows(keys, rules, rows=None):
+    """
+    Parse the rules of many spreadsheet rows; each distinct rule text is parsed once.
+
+    A row is rejected when its key or rule is missing or its rule doesn't parse. As before, a key appearing on
+    several rows keeps the rules of the last one; earlier rows with different rules are reported as overridden.
+
+    :param keys: key (reaction) of each row
+    :param rules: rule text of each row
+    :param rows: spreadsheet row numbers used in the report (default: 2, 3, ...)
+    :return: (dict of key -> set of frozensets of KOs, issues DataFrame)
+    """
+    keys, rules = list(keys), list(rules)
+    rows = list(range(2, len(keys) + 2)) if rows is None else list(rows)
+    parsed, unusual = dict(), dict()
+    for rule in set(r for r in rules if isinstance(r, str)):
+        try:
+            parsed[rule] = parse_rule(rule)
+        except RuleSyntaxError as e:
+            parsed[rule] = e
+            continue
+        unusual[rule] = sorted({ko for fs in parsed[rule] for ko in fs if not KO_ID.match(ko) and ko not in SPECIAL_KOS})
+
+    out, source, issues = dict(), dict(), []
+    for row, key, rule in zip(rows, keys, rules):
+        key = key.strip() if isinstance(key, str) else None
+        rule = rule if isinstance(rule, str) else None
+        if not key:
+            issues.append((row, key, rule, "missing reaction", True))
+        elif rule is None:
+            issues.append((row, key, rule, "missing rule", True))
+        elif isinstance(parsed[rule], RuleSyntaxError):
+            issues.append((row, key, rule, "syntax error: %s" % parsed[rule], True))
+        else:
+            sets = parsed[rule]
+            if unusual[rule]:
+                issues.append((row, key, rule, "unusual KO ID: %s" % ", ".join(unusual[rule]), False))
+            if key in out and out[key] != sets:
+                issues.append((source[key][0], key, source[key][1], "overridden by row %d" % row, True))
+            out[key] = set(sets)
+            source[key] = (row, rule)
+
+    issues = pd.DataFrame(issues, columns=ISSUE_COLUMNS).sort_values("row", kind="stable").reset_index(drop=True)
+    return out, issues
+
+def read_rule_sheet(path, key_col, rule_col, where=None, extra_cols=()):
+    """
+    Read the key and rule columns of a spreadsheet (the wide text columns are never loaded) and parse its rules.
+
+    :param where: optional function of the DataFrame returning a mask of the rows to use
+    :param extra_cols: other columns `where` needs
+    :return: (dict of key -> set of frozensets of KOs, issues DataFrame), see parse_rule_rows
+    """
+    spreadsheet = pd.read_csv(path, usecols=[key_col, rule_col, *extra_cols], dtype=str, index_col=False)
+    if where is not None:
+        spreadsheet = spreadsheet[where(spreadsheet)]
+    return parse_rule_rows(spreadsheet[key_col].tolist(), spreadsheet[rule_col].tolist(), (spreadsheet.index + 2).tolist())
@@ -0,0 +1,169 @@
+"""
+Streaming gene -> KO annotation tables into per-genome KO profiles, and evaluating them as they arrive.
+
+Files are read in chunks with pandas, so memory is bounded by the chunk size and the genome being
+collected, not by the file. Rows of a genome must be contiguous (as written by the annotation tools,
+or after sorting by genome); a genome showing up again after another one raises a ValueError.
+
+Supported formats:
+    "kofamscan"         KofamScan `-f mapper` output: gene<TAB>KO, genes without a KO have no 2nd column
+    "kofamscan-detail"  KofamScan detail output; only rows marked "*" (above threshold) are used
+    "eggnog"            eggNOG-mapper `.annotations`, KOs taken from the KEGG_ko column ("ko:K00001,ko:K00002")
+    "tabular"           any delimited file with a header, KOs and genomes taken from `ko_col`/`genome_col`
+
+Only "tabular" files can name the genome in a column. For the others every gene belongs to `genome`
+(default: the file name without extension), unless `genome_of` maps gene IDs to genome IDs
+(e.g. `lambda gene: gene.rsplit("_", 1)[0]`).
+"""
+
+import os
+import itertools
+
+import numpy as np
+import pandas as pd
+
+FORMATS = ("kofamscan", "kofamscan-detail", "eggnog", "tabular")
+
+def default_genome_name(path):
+    return os.path.basename(path).split(".")[0]
+
+def read_gene_ko_chunks(path, format="kofamscan", genome=None, genome_of=None, chunksize=10**6,
+                        genome_col="genome", gene_col="gene", ko_col="ko", sep="\t"):
+    """
+    Yields DataFrames with "genome" and "ko" columns, in file order.
+
+    A row's "ko" is missing (NaN) for genes without a KO, so that genomes without any KO still show up.
+    See the module docstring for the formats and how genomes are named.
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown format %r, expected one of %s" % (format, ", ".join(FORMATS)))
+    if genome is None:
+        genome = default_genome_name(path)
+
+    if format == "kofamscan":
+        chunks = pd.read_csv(path, sep="\t", header=None, names=["gene", "ko"], usecols=[0, 1], dtype=str, chunksize=chunksize)
+    elif format == "kofamscan-detail":
+        chunks = _read_kofamscan_detail(path, chunksize)
+    elif format == "eggnog":
+        chunks = _read_eggnog(path, chunksize)
+    else:
+        usecols = [ko_col] + ([gene_col] if genome_of else [genome_col] if genome_col else [])
+        chunks = pd.read_csv(path, sep=sep, usecols=usecols, dtype=str, chunksize=chunksize)
+
+    for chunk in chunks:
+        if format == "tabular":
+            chunk = chunk.rename(columns={ko_col: "ko", gene_col: "gene"})
+        if format == "tabular" and genome_col and not genome_of:
+            genomes = chunk[genome_col]
+        elif genome_of is not None:
+            genomes = chunk["gene"].map(genome_of)
+        else:
+            genomes = pd.Series(genome, index=chunk.index)
+
+        out = pd.DataFrame({"genome": genomes, "ko": chunk["ko"].where(chunk["ko"] != "-")})
+        if format == "eggnog": ## Several KOs per gene
+            out["ko"] = out["ko"].str.replace("ko:", "", regex=False).str.split(",")
+            out = out.explode("ko")
+        yield out
+
+def _read_kofamscan_detail(path, chunksize):
+    ## ["*"] gene KO threshold score E-value "definition"; rows without the "*" flag are below threshold
+    with open(path) as f:
+        lines = (line for line in f if not line.startswith("#"))
+        while True:
+            rows = [_kofamscan_detail_row(line) for line in itertools.islice(lines, chunksize)]
+            if not rows:
+                return
+            yield pd.DataFrame([r for r in rows if r is not None], columns=["gene", "ko"])
+
+def _kofamscan_detail_row(line):
+    ## (gene, KO if above threshold else None), or None for blank lines
+    fields = line.split(None, 3)
+    marked = bool(fields) and fields[0] == "*"
+    if marked:
+        fields = fields[1:]
+    if len(fields) < 2:
+        return None
+    return fields[0], fields[1] if marked else None
+
+def _read_eggnog(path, chunksize):
+    ## Comment lines start with "##"; the header line starts with "#query"
+    with open(path) as f:
+        skip = 0
+        for line in f:
+            if line.startswith("#query") or not line.startswith("##"):
+                break
+            skip += 1
+    header = line.lstrip("#").rstrip("\n").split("\t")
+    chunks = pd.read_csv(path, sep="\t", header=None, skiprows=skip + 1, usecols=[0, header.index("KEGG_ko")],
+                         dtype=str, chunksize=chunksize)
+    for chunk in chunks:
+        chunk.columns = ["gene", "ko"]
+        yield chunk[~chunk["gene"].str.startswith("##")] ## Trailing comments
+
+def iter_ko_profiles(paths, format="kofamscan", chunksize=10**6, **kwargs):
+    """
+    Yields (genome, set of KOs) for each genome in one or more annotation files, as soon as it is complete.
+
+    :param paths: path, or list of paths read one after another
+    :param kwargs: passed to read_gene_ko_chunks (genome, genome_of, genome_col, ko_col, sep...)
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    finished = set()
+    current, kos = None, set()
+    for path in paths:
+        for chunk in read_gene_ko_chunks(path, format, chunksize=chunksize, **kwargs):
+            genomes = chunk["genome"].to_numpy()
+            chunk_kos = chunk["ko"].to_numpy()
+            starts = np.concatenate([[0], np.flatnonzero(genomes[1:] != genomes[:-1]) + 1, [len(genomes)]]) ## Runs of one genome
+            for start, end in zip(starts[:-1], starts[1:]):
+                genome = genomes[start]
+                if genome != current:
+                    if current is not None:
+                        yield current, kos
+                        finished.add(current)
+                    if genome in finished:
+                        raise ValueError("Rows of genome %r are not contiguous in %s; sort the input by genome first" % (genome, path))
+                    current, kos = genome, set()
+                kos.update(ko for ko in chunk_kos[start:end] if isinstance(ko, str)) ## Skips missing KOs
+    if current is not None:
+        yield current, kos
+
+def iter_batches(profiles, batch_size):
+    """Groups (genome, KOs) pairs into dicts of up to `batch_size` genomes"""
+    batch = dict()
+    for genome, kos in profiles:
+        batch[genome] = kos
+        if len(batch) == batch_size:
+            yield batch
+            batch = dict()
+    if batch:
+        yield batch
+
+def evaluate_stream(profiles, modules=None, reactions=None, modules_OUTPATH=None, reactions_OUTPATH=None,
+                    batch_size=4096, best_sets=False):
+    """
+    Evaluates KO profiles (e.g. from iter_ko_profiles) batch by batch, appending each batch's results to TSVs.
+
+    :param modules: ModuleCompleteness engine; writes genome x module completeness to `modules_OUTPATH`
+    :param reactions: ReactionFeasibility engine; writes genome x reaction 0/1 feasibility to `reactions_OUTPATH`
+    :param best_sets: also write "<modules_OUTPATH>.best.tsv" with the best matching KO set of each module
+        ("+"-joined KOs)
+    :return: number of genomes evaluated
+    """
+    n = 0
+    for i, batch in enumerate(iter_batches(profiles, batch_size)):
+        mode, header = ("w", True) if i == 0 else ("a", False)
+        if modules is not None:
+            completeness, best = modules.evaluate_genomes(batch, batch_size)
+            completeness.to_csv(modules_OUTPATH, sep="\t", mode=mode, header=header, index_label="genome", float_format="%.4g")
+            if best_sets:
+                best = best.apply(lambda col: col.map(lambda fs: "+".join(sorted(fs))))
+                best.to_csv(modules_OUTPATH + ".best.tsv", sep="\t", mode=mode, header=header, index_label="genome")
+        if reactions is not None:
+            feasible = reactions.evaluate_genomes(batch, batch_size)
+            feasible.astype(np.int8).to_csv(reactions_OUTPATH, sep="\t", mode=mode, header=header, index_label="genome")
+        n += len(batch)
+    return n
@@ -0,0 +1,142 @@
+"""
+Dense integer ids for KEGG identifiers, and KO sets as int bitmasks.
+
+Bit `i` of a mask is the KO with id `i`, so unions are `|`, intersections are `&`
+and "a is a subset of b" is `a & ~b == 0`, without hashing or comparing strings.
+Masks only mean something together with the SymbolTable that made them; convert
+back with `unmask`/`decode_rules` before writing anything out.
+"""
+
+import tracemalloc
+
+class SymbolTable:
+    """
+    Maps identifiers to dense integers, numbering each kind ("ko", "rn", "mo", ...) separately from 0.
+
+    Ids are assigned in the order identifiers are first seen.
+    """
+
+    def __init__(self):
+        self.ids = dict() ## kind -> {name: id}
+        self.names = dict() ## kind -> [name, ...]
+
+    @classmethod
+    def from_names(cls, names, kind="ko"):
+        """Table numbering `names` 0, 1, 2... in the given order (e.g. a rule file's KO table)"""
+        symbols = cls()
+        for name in names:
+            symbols.encode(name, kind)
+        return symbols
+
+    def __len__(self):
+        return sum(len(names) for names in self.names.values())
+
+    def encode(self, name, kind="ko"):
+        """Id of `name`, adding it if it hasn't been seen"""
+        ids = self.ids.setdefault(kind, dict())
+        i = ids.get(name)
+        if i is None:
+            names = self.names.setdefault(kind, [])
+            i = ids[name] = len(names)
+            names.append(name)
+        return i
+
+    def decode(self, i, kind="ko"):
+        return self.names[kind][i]
+
+    def mask(self, names, kind="ko"):
+        """Bitmask of a collection of identifiers"""
+        m = 0
+        for name in names:
+            m |= 1 << self.encode(name, kind)
+        return m
+
+    def unmask(self, mask, kind="ko"):
+        """Frozenset of the identifiers in a bitmask"""
+        names = self.names.get(kind, [])
+        members = []
+        while mask:
+            low = mask & -mask
+            members.append(names[low.bit_length() - 1])
+            mask ^= low
+        return frozenset(members)
+
+    def encode_links(self, links, kind="ko"):
+        """dict of key -> iterable of ids (e.g. rn_to_ko_dict) to dict of key -> mask"""
+        return {k: self.mask(v, kind) for k, v in links.items()}
+
+    def encode_rules(self, rules, kind="ko"):
+        """dict of key -> set of frozensets (a rule map) to dict of key -> set of masks"""
+        return {k: {self.mask(fs, kind) for fs in ruleset} for k, ruleset in rules.items()}
+
+    def decode_rules(self, rules, kind="ko"):
+        """Inverse of `encode_rules`"""
+        return {k: {self.unmask(m, kind) for m in ruleset} for k, ruleset in rules.items()}
+
+def is_subset(a, b):
+    """True if mask `a` is a subset of mask `b`"""
+    return a & ~b == 0
+
+class RuleSetPool:
+    """
+    Interns KO sets, so every equal frozenset (and every equal KO string in them) is one shared object.
+
+    Rule maps hold many copies of the same sets (`frozenset({'K00844'})` in several maps and modules);
+    passing them through one pool keeps a single object per distinct set. Interned frozensets are
+    immutable, so sharing them is safe; the sets of frozensets holding them are never shared.
+    A pool isn't thread safe: intern from one thread at a time.
+    """
+
+    def __init__(self):
+        self.kos = dict() ## KO -> the KO string used in every set
+        self.sets = dict() ## frozenset -> its shared instance
+        self.requested = 0 ## Sets passed in, to compare with len(self)
+
+    def __len__(self):
+        return len(self.sets)
+
+    def __contains__(self, kos):
+        return frozenset(kos) in self.sets
+
+    def intern(self, kos):
+        """Shared frozenset equal to the iterable `kos`"""
+        self.requested += 1
+        if isinstance(kos, frozenset):
+            shared = self.sets.get(kos)
+            if shared is not None:
+                return shared
+        fs = frozenset(self.kos.setdefault(ko, ko) for ko in kos)
+        return self.sets.setdefault(fs, fs)
+
+    def ruleset(self, ruleset):
+        """New set holding the shared instances of a ruleset's frozensets"""
+        return {self.intern(fs) for fs in ruleset}
+
+    def rules(self, rules):
+        """New rule map (ID -> set of frozensets) over shared frozensets"""
+        return {key: self.ruleset(ruleset) for key, ruleset in rules.items()}
+
+    def maps(self, maps):
+        """`rules` for each map of a dict of rule maps; maps that are None stay None"""
+        return {name: None if rules is None else self.rules(rules) for name, rules in maps.items()}
+
+
+def measure_memory(build):
+    """
+    Calls `build()` under tracemalloc, returning (its result, bytes still allocated, peak bytes).
+
+    Only allocations made while `build` runs count, so the retained figure is what its result
+    (and anything else it left alive) holds. Work done in other processes isn't traced.
+    """
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = build()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+    return result, current - before, peak - before
@@ -0,0 +1,84 @@
+"""
+Long tables of rule maps (one row per ID, origin and KO set), written straight from the maps in chunks.
+
+Rows are sorted by origin, then ID, then KO set, and each KO set is a sorted list of KOs:
+
+    reaction,origin,rule
+    R00005,map_rn2ko_viaKO_2plus,K01457+K14541
+
+CSV files join a set's KOs with "+" (the AND of the manually mapped spreadsheets, so `Mapping.parse_rule`
+reads a row back); Parquet files store them as a list<string> column. Parquet needs pyarrow, which is
+imported only when a Parquet file is written or read.
+"""
+
+import csv
+
+def iter_rule_rows(maps):
+    """
+    Yields (ID, origin, sorted list of KOs) for every KO set of every map, sorted by origin, ID and KOs.
+
+    :param maps: dict of origin -> dict of ID -> set of frozensets of KOs; origins whose map is None are skipped
+    """
+    for origin in sorted(o for o, rules in maps.items() if rules is not None):
+        rules = maps[origin]
+        for key in sorted(rules):
+            for kos in sorted(sorted(fs) for fs in rules[key]):
+                yield key, origin, kos
+
+def iter_chunks(rows, chunksize):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet rule tables need pyarrow (pip install pyarrow); CSV works without it") from None
+    return pyarrow
+
+def write_rules_csv(OUTPATH, maps, key_col="reaction", chunksize=10000):
+    """Write maps (see iter_rule_rows) to a CSV with `key_col`, "origin" and "rule" columns"""
+    with open(OUTPATH, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([key_col, "origin", "rule"])
+        for chunk in iter_chunks(iter_rule_rows(maps), chunksize):
+            writer.writerows((key, origin, "+".join(kos)) for key, origin, kos in chunk)
+
+def write_rules_parquet(OUTPATH, maps, key_col="reaction", chunksize=10000):
+    """Write maps (see iter_rule_rows) to Parquet, one row group per chunk, with "rule" as a list of KOs"""
+    pa = _pyarrow()
+    schema = pa.schema([(key_col, pa.string()), ("origin", pa.string()), ("rule", pa.list_(pa.string()))])
+    with pa.parquet.ParquetWriter(OUTPATH, schema) as writer:
+        for chunk in iter_chunks(iter_rule_rows(maps), chunksize):
+            keys, origins, rules = zip(*chunk)
+            writer.write_table(pa.table([list(keys), list(origins), list(rules)], schema=schema))
+
+def write_rules_table(OUTPATH, maps, key_col="reaction", chunksize=10000):
+    """Write maps as Parquet if OUTPATH ends in ".parquet", CSV otherwise"""
+    if OUTPATH.endswith(".parquet"):
+        write_rules_parquet(OUTPATH, maps, key_col, chunksize)
+    else:
+        write_rules_csv(OUTPATH, maps, key_col, chunksize)
+
+def _read_rows(path, key_col):
+    if path.endswith(".parquet"):
+        table = _pyarrow().parquet.read_table(path, columns=[key_col, "origin", "rule"]).to_pydict()
+        yield from zip(table[key_col], table["origin"], table["rule"])
+        return
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            yield row[key_col], row["origin"], row["rule"].split("+") if row["rule"] else []
+
+def read_rules_table(path, key_col="reaction"):
+    """Read a table written by write_rules_table back into origin -> ID -> set of frozensets of KOs"""
+    maps = dict()
+    for key, origin, kos in _read_rows(path, key_col):
+        maps.setdefault(origin, dict()).setdefault(key, set()).add(frozenset(kos))
+    return maps
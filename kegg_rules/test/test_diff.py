@@ -0,0 +1,59 @@
+import os
+import pickle
+import tempfile
+import unittest
+import sys
+sys.path.append("..")
+from kegg_rules.diff import MapHashes, diff_maps, diff_files, summarize_diff, load_maps, ruleset_hash, DIFF_COLUMNS
+from kegg_rules.rulefile import write_rule_maps
+
+OLD = {"map_a": {"R1": {frozenset(["K1", "K2"]), frozenset(["K3"])}, "R2": {frozenset(["K4"])}, "R3": {frozenset(["K5"])}},
+       "map_b": {"R1": {frozenset(["spontaneous"])}},
+       "map_gone": {"R9": {frozenset(["K9"])}},
+       "map_none": None}
+NEW = {"map_a": {"R1": {frozenset(["K2", "K1"]), frozenset(["K6"])}, "R2": {frozenset(["K4"])}, "R4": {frozenset(["K7"])}},
+       "map_b": {"R1": {frozenset(["spontaneous"])}}}
+
+class TestDiff(unittest.TestCase):
+    def test_hash_ignores_order(self):
+        a = {frozenset(["K1", "K2"]), frozenset(["K3"])}
+        b = {frozenset(["K3"]), frozenset(["K2", "K1"])}
+        self.assertEqual(ruleset_hash("R1", a), ruleset_hash("R1", b))
+        self.assertNotEqual(ruleset_hash("R1", a), ruleset_hash("R2", a))
+        self.assertNotEqual(ruleset_hash("R1", a), ruleset_hash("R1", {frozenset(["K1", "K2", "K3"])}))
+
+    def test_report(self):
+        report = diff_maps(OLD, NEW)
+        self.assertEqual(list(report.columns), DIFF_COLUMNS)
+        self.assertEqual([tuple(row) for row in report.itertuples(index=False)],
+                         [("map_a", "R1", "changed", ["K6"], ["K3"]),
+                          ("map_a", "R3", "removed", [], ["K5"]),
+                          ("map_a", "R4", "added", ["K7"], []),
+                          ("map_gone", "R9", "removed", [], ["K9"])])
+        summary = summarize_diff(report)
+        self.assertEqual(summary.loc["map_a"].tolist(), [1, 1, 1])
+        self.assertEqual(summary.loc["map_gone"].tolist(), [0, 1, 0])
+
+    def test_unchanged(self):
+        hashes = MapHashes(OLD)
+        self.assertEqual(len(diff_maps(hashes, OLD)), 0)
+        self.assertEqual(len(summarize_diff(diff_maps(NEW, NEW))), 0)
+        with self.assertRaises(ValueError):
+            diff_maps(hashes, MapHashes(NEW, buckets=8))
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            old_path, new_path = os.path.join(tmp, "old.pkl"), os.path.join(tmp, "new.rules")
+            with open(old_path, "wb") as f:
+                pickle.dump(OLD, f)
+            write_rule_maps(new_path, NEW)
+            self.assertTrue(diff_files(old_path, new_path).equals(diff_maps(OLD, NEW)))
+
+            ## A single map, like calculated_module_dict, is named after its file
+            single = os.path.join(tmp, "calculated_module_dict.pkl")
+            with open(single, "wb") as f:
+                pickle.dump(NEW["map_a"], f)
+            self.assertEqual(load_maps(single), {"calculated_module_dict": NEW["map_a"]})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import pickle
+import unittest
+import sys
+sys.path.append("..")
+from kegg_rules.evaluate import KOSetMatrix, ModuleCompleteness, ReactionFeasibility
+from kegg_rules.rulefile import RuleFile
+
+class TestModuleCompleteness(unittest.TestCase):
+    def setUp(self):
+        with open("../module_ko_to_rn/assets/calculated_module_dict.pkl", 'rb') as f:
+            self.calculated_module_dict = pickle.load(f)
+        self.engine = ModuleCompleteness(self.calculated_module_dict)
+
+    def test_small_example(self):
+        engine = ModuleCompleteness({"M1": {frozenset(["K1", "K2"]), frozenset(["K3"])},
+                                     "M2": {frozenset(["K1", "K2", "K4", "K5"])}})
+        completeness, best = engine.evaluate_genomes({"g1": ["K1"], "g2": ["K3", "K1", "K4"], "g3": []})
+        self.assertEqual(completeness.loc["g1"].tolist(), [0.5, 0.25])
+        self.assertEqual(completeness.loc["g2"].tolist(), [1.0, 0.5])
+        self.assertEqual(completeness.loc["g3"].tolist(), [0.0, 0.0])
+        self.assertEqual(best.loc["g1", "M1"], frozenset(["K1", "K2"]))
+        self.assertEqual(best.loc["g2", "M1"], frozenset(["K3"]))
+
+    def test_matches_set_logic(self):
+        genomes = {"M00009_only": set.union(*map(set, self.calculated_module_dict["M00009"])),
+                   "few": {"K00031", "K00382", "K01616", "K00844", "K99999"},
+                   "empty": set()}
+        completeness, best = self.engine.evaluate_genomes(genomes, batch_size=2)
+        for g, kos in genomes.items():
+            for mid, sets in self.calculated_module_dict.items():
+                expected = max(len(fs & kos) / len(fs) for fs in sets)
+                self.assertAlmostEqual(completeness.loc[g, mid], expected, places=6, msg=(g, mid))
+                fs = best.loc[g, mid]
+                self.assertIn(fs, sets)
+                self.assertAlmostEqual(len(fs & kos) / len(fs), expected, places=6, msg=(g, mid))
+
+    def test_from_rulefile(self):
+        engine = ModuleCompleteness.from_rulefile(RuleFile("../module_ko_to_rn/assets/calculated_module_dict.rules"))
+        genomes = {"g1": {"K00031", "K00382", "K01616", "K00844"}, "g2": set(self.engine.sets.symbols.names["ko"][::4])}
+        completeness, best = self.engine.evaluate_genomes(genomes)
+        from_file, best_from_file = engine.evaluate_genomes(genomes)
+        self.assertTrue(completeness.equals(from_file[completeness.columns]))
+        self.assertTrue((best == best_from_file[best.columns]).all().all())
+
+    def test_empty_sets_and_families(self):
+        engine = ModuleCompleteness({"M1": {frozenset(), frozenset(["K1"])}, "M2": {frozenset(["K2", "K3"])}})
+        completeness, best = engine.evaluate_genomes({"g1": [], "g2": ["K1", "K2"]})
+        self.assertEqual(completeness.loc["g1"].tolist(), [1.0, 0.0])
+        self.assertEqual(completeness.loc["g2"].tolist(), [1.0, 0.5])
+        self.assertEqual(best.loc["g1", "M1"], frozenset())
+        self.assertEqual(best.loc["g1", "M2"], frozenset(["K2", "K3"]))
+        with self.assertRaises(ValueError):
+            KOSetMatrix({"M1": {frozenset(["K1"])}, "M2": set()})
+
+    def test_hits_stay_sparse(self):
+        genome_ids, presence = self.engine.sets.presence({"g1": ["K00031"], "g2": []})
+        hits = self.engine.sets.hits(presence)
+        self.assertTrue(hits.shape == (2, len(self.engine.sets)) and hits.nnz > 0)
+        self.assertEqual(hits.getnnz(axis=1).tolist(), [hits.nnz, 0])
+
+    def test_ignore(self):
+        matrix = KOSetMatrix({"R1": {frozenset(["K1", "spontaneous"])}}, ignore=("spontaneous",))
+        self.assertEqual(matrix.sizes.tolist(), [1])
+        self.assertEqual(matrix.n_kos, 1)
+
+class TestReactionFeasibility(unittest.TestCase):
+    def setUp(self):
+        with open("../mapping/final_map/v3/rn2ko_map_combined.pkl", 'rb') as f:
+            self.rn2ko_map = pickle.load(f)
+        self.engine = ReactionFeasibility(self.rn2ko_map)
+
+    def test_from_rulefile(self):
+        ## All origins of the by-type file together are the combined map
+        engine = ReactionFeasibility.from_rulefile(RuleFile("../mapping/final_map/v3/rn2ko_map_by_type.rules", mmap=True))
+        kos = sorted({ko for rules in self.rn2ko_map.values() for fs in rules for ko in fs})
+        genomes = {"every_other": kos[::2], "every_fifth": kos[::5], "none": []}
+        expected = self.engine.evaluate_genomes(genomes)
+        self.assertTrue(expected.equals(engine.evaluate_genomes(genomes)[expected.columns]))
+
+    def test_small_example(self):
+        engine = ReactionFeasibility({"R1": {frozenset(["K1", "K2"]), frozenset(["K3"])},
+                                      "R2": {frozenset(["spontaneous"])},
+                                      "R3": {frozenset(["K4", "spontaneous"])}})
+        feasible = engine.evaluate_genomes({"g1": ["K1"], "g2": ["K1", "K2", "K4"], "g3": []})
+        self.assertEqual(feasible.loc["g1"].tolist(), [False, True, False])
+        self.assertEqual(feasible.loc["g2"].tolist(), [True, True, True])
+        self.assertEqual(feasible.loc["g3"].tolist(), [False, True, False])
+
+    def test_matches_set_logic(self):
+        kos = sorted({ko for rules in self.rn2ko_map.values() for fs in rules for ko in fs})
+        genomes = {"all": kos, "every_third": kos[::3], "none": []}
+        feasible = self.engine.evaluate_genomes(genomes, batch_size=2)
+        for g, genome_kos in genomes.items():
+            genome_kos = set(genome_kos) | {"spontaneous"}
+            expected = [any(fs <= genome_kos for fs in self.rn2ko_map[r]) for r in self.engine.reactions]
+            self.assertEqual(feasible.loc[g].tolist(), expected, g)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import sys
+import random
+
+sys.path.append("..")
+from kegg_rules.keywords import KeywordTagger
+
+KEYWORDS = ["effector", "anchor", "pts", "subunit", "chain", "reductase component", "multi step", "multistep", "step"]
+
+def test_tag_matches_substring_search():
+    random.seed(0)
+    words = ["PTSubunit", "ptsubunit", "Chain", "multi step", "multistep", "reductase", "component", "x", "", "effect", "anchor"]
+    tagger = KeywordTagger(KEYWORDS)
+    texts = dict()
+    for i in range(500):
+        text = random.choice([" ", "", "-"]).join(random.choice(words) for _ in range(random.randint(0, 5)))
+        assert tagger.keywords_in(text) == [k for k in KEYWORDS if k in text.lower()]
+        texts[i] = text
+    table = tagger.tag_all(texts)
+    for i, text in texts.items():
+        assert table.loc[i].tolist() == [k in text.lower() for k in KEYWORDS]
+
+def test_case_sensitive():
+    tagger = KeywordTagger(["PTS", "chain"], case_sensitive=True)
+    assert tagger.keywords_in("PTS Chain") == ["PTS"]
+
+def test_tag_all():
+    tagger = KeywordTagger(["spontaneous", "non-enzymatic"])
+    table = tagger.tag_all({"R1": "Spontaneous reaction", "R2": "", "R3": "non-enzymatic; spontaneous"})
+    assert list(table.columns) == ["spontaneous", "non-enzymatic"]
+    assert table.loc["R1"].tolist() == [True, False]
+    assert table.loc["R2"].tolist() == [False, False]
+    assert table.loc["R3"].tolist() == [True, True]
+    assert table.dtypes.eq(bool).all()
+    assert tagger.tag_all(dict()).shape == (0, 2)
+
+def test_duplicate_keywords():
+    tagger = KeywordTagger(["chain", "Chain", "chai"])
+    assert tagger.keywords_in("alpha CHAIN") == ["chain", "Chain", "chai"]
@@ -0,0 +1,116 @@
+import os
+import pickle
+import struct
+import tempfile
+import unittest
+import multiprocessing
+import subprocess
+import sys
+sys.path.append("..")
+from kegg_rules.rulefile import RuleFile, write_rule_map, write_rule_maps, MAGIC, share, convert_pickle
+
+def lookup_in_shared(task):
+    name, key = task
+    with RuleFile.attach(name) as rules:
+        return rules.get(key)
+
+class TestRuleFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "maps.rules")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        maps = {"a": {"R1": {frozenset(["K2", "K1"]), frozenset(["K3"])}, "R2": set()},
+                "b": {"R1": {frozenset(["K3"]), frozenset(["spontaneous"])}},
+                "empty": dict(),
+                "skipped": None}
+        write_rule_maps(self.path, maps, meta={"snapshot": "test"})
+        rules = RuleFile(self.path)
+        self.assertEqual(rules.origins, ["a", "b", "empty"])
+        self.assertEqual(rules.meta, {"snapshot": "test"})
+        self.assertEqual(rules.to_maps(), {"a": maps["a"], "b": maps["b"], "empty": dict()})
+        self.assertEqual(rules.get("R1"), {frozenset(["K1", "K2"]), frozenset(["K3"]), frozenset(["spontaneous"])})
+        self.assertEqual(rules.get("R1", origin="b"), maps["b"]["R1"])
+        self.assertEqual(rules.get("R2", origin="a"), set())
+        self.assertIsNone(rules.get("R2", origin="b"))
+        self.assertEqual(rules.origins_of("R1"), ["a", "b"])
+        self.assertNotIn("R3", rules)
+        with self.assertRaises(KeyError):
+            rules["R3"]
+        self.assertEqual(rules.key_indices(["R2", "R11", "R1"]).tolist(), [1, -1, 0])
+
+    def test_rejects_other_files(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\x80\x04not a rule file")
+        with self.assertRaises(ValueError):
+            RuleFile(self.path)
+        with open(self.path, "wb") as f:
+            f.write(MAGIC + struct.pack("<II", 99, 2) + b"{}")
+        with self.assertRaises(ValueError):
+            RuleFile(self.path)
+
+    def test_stored_maps(self):
+        with open("../mapping/final_map/v3/rn2ko_map_by_type.pkl", 'rb') as f:
+            by_type = pickle.load(f)
+        with open("../mapping/final_map/v3/rn2ko_map_combined.pkl", 'rb') as f:
+            combined = pickle.load(f)
+        self.assertEqual(RuleFile("../mapping/final_map/v3/rn2ko_map_by_type.rules").to_maps(), by_type)
+        rules = RuleFile("../mapping/final_map/v3/rn2ko_map_combined.rules")
+        self.assertEqual(rules.to_dict(), combined)
+        with open("../module_ko_to_rn/assets/calculated_module_dict.pkl", 'rb') as f:
+            calculated_module_dict = pickle.load(f)
+        write_rule_map(self.path, calculated_module_dict, origin="calculated")
+        self.assertEqual(RuleFile(self.path)["M00009"], calculated_module_dict["M00009"])
+
+class TestSharedRuleFile(unittest.TestCase):
+    def setUp(self):
+        with open("../mapping/final_map/v3/rn2ko_map_combined.pkl", 'rb') as f:
+            self.combined = pickle.load(f)
+        self.path = "../mapping/final_map/v3/rn2ko_map_combined.rules"
+
+    def test_mmap(self):
+        with RuleFile(self.path, mmap=True) as rules:
+            self.assertEqual(rules.to_dict(), self.combined)
+
+    def test_shared_memory_workers(self):
+        shm = share(self.path)
+        try:
+            keys = ["R07406", "R01518", "R00267", "R99999"]
+            with multiprocessing.Pool(2) as pool:
+                found = pool.map(lookup_in_shared, [(shm.name, key) for key in keys])
+            self.assertEqual(found, [self.combined.get(key) for key in keys])
+            with RuleFile.attach(shm.name) as rules: ## Still there after the workers exit
+                self.assertEqual(len(rules), len(self.combined))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def test_attach_from_unrelated_process(self):
+        ## A process with its own resource tracker mustn't unlink the block when it exits
+        shm = share(self.path)
+        try:
+            script = ("import sys; sys.path.append('..'); from kegg_rules.rulefile import RuleFile\n"
+                      "with RuleFile.attach(%r) as rules: print(len(rules))" % shm.name)
+            result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+            self.assertEqual(int(result.stdout), len(self.combined))
+            self.assertNotIn("resource_tracker", result.stderr)
+            with RuleFile.attach(shm.name) as rules:
+                self.assertEqual(len(rules), len(self.combined))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def test_convert_pickle(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            OUTPATH = os.path.join(tmp, "by_type.rules")
+            convert_pickle("../mapping/final_map/v3/rn2ko_map_by_type.pkl", OUTPATH)
+            with open("../mapping/final_map/v3/rn2ko_map_by_type.pkl", 'rb') as f:
+                self.assertEqual(RuleFile(OUTPATH).to_maps(), pickle.load(f))
+            convert_pickle("../module_ko_to_rn/assets/calculated_module_dict.pkl", OUTPATH, origin="calculated")
+            self.assertEqual(RuleFile(OUTPATH).origins, ["calculated"])
+
+if __name__ == '__main__':
+    unittest.main()
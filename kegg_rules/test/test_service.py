@@ -0,0 +1,104 @@
+import os
+import json
+import pickle
+import socket
+import asyncio
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import sys
+sys.path.append("..")
+from kegg_rules.service import RuleService, RuleClient
+
+class TestRuleService(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open("../mapping/final_map/v3/rn2ko_map_by_type.pkl", 'rb') as f:
+            cls.by_type = pickle.load(f)
+        with open("../mapping/final_map/v3/rn2ko_map_combined.pkl", 'rb') as f:
+            cls.combined = pickle.load(f)
+        with open("../module_ko_to_rn/assets/calculated_module_dict.pkl", 'rb') as f:
+            cls.calculated_module_dict = pickle.load(f)
+
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.unix = os.path.join(cls.tmp.name, "rules.sock")
+        cls.service = RuleService(cache_size=16)
+        cls.loop = asyncio.new_event_loop()
+        cls.tcp_server = cls.loop.run_until_complete(cls.service.start(port=0))
+        cls.unix_server = cls.loop.run_until_complete(cls.service.start(unix=cls.unix))
+        cls.port = cls.tcp_server.sockets[0].getsockname()[1]
+        cls.thread = threading.Thread(target=cls.loop.run_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.tcp_server.close()
+        cls.unix_server.close()
+        cls.tmp.cleanup()
+
+    def test_rules(self):
+        client = RuleClient(port=self.port)
+        reactions = ["R07406", "R01518", "R99999"]
+        self.assertEqual(client.rules(reactions), {r: self.combined.get(r) for r in reactions})
+        self.assertEqual(client.rules(["R07406"], origin="map_rn2ko_spontaneous"), {"R07406": self.by_type["map_rn2ko_spontaneous"]["R07406"]})
+        self.assertEqual(client.module_sets(["M00009"]), {"M00009": self.calculated_module_dict["M00009"]})
+        client.close()
+
+    def test_evaluation_over_unix_socket(self):
+        client = RuleClient(unix=self.unix)
+        genome = set.union(*map(set, self.calculated_module_dict["M00009"]))
+        completeness, complete = client.completeness({"g1": genome, "g2": []})
+        self.assertEqual(completeness["g1"]["M00009"], 1.0)
+        self.assertIn("M00009", complete["g1"])
+        self.assertEqual(complete["g2"], [])
+        feasible = client.feasibility({"g1": genome})["g1"]
+        self.assertEqual(set(feasible), {r for r, rules in self.combined.items() if any(fs <= genome | {"spontaneous"} for fs in rules)})
+        client.close()
+
+    def test_keep_alive_and_cache(self):
+        client = RuleClient(port=self.port)
+        before = client.health()["cache"]["hits"]
+        first = client.rules(["R00267"])
+        sock = client.connection.sock
+        self.assertEqual(client.rules(["R00267"]), first)
+        self.assertIs(client.connection.sock, sock) ## Same connection reused
+        self.assertEqual(client.health()["cache"]["hits"], before + 1)
+        with self.assertRaises(ValueError):
+            client.request("/rules", {"wrong": []})
+        with self.assertRaises(ValueError):
+            client.request("/nothing", {})
+        client.close()
+
+    def test_errors_keep_the_connection(self):
+        client = RuleClient(port=self.port)
+        sock = None
+        ## Valid JSON of the wrong shape is a 400, and the connection stays usable
+        for path, payload in [("/completeness", {"genomes": {"g1": 5}}), ("/feasibility", {"genomes": [1, 2]}),
+                              ("/rules", {"reactions": [["R00267"]]}), ("/modules", [1])]:
+            with self.assertRaisesRegex(ValueError, "failed \\(400\\)"):
+                client.request(path, payload)
+            sock = sock or client.connection.sock
+            self.assertIs(client.connection.sock, sock)
+        ## Anything else an endpoint raises is a 500
+        with mock.patch.dict(self.service.routes, {"/rules": lambda request: 1/0}):
+            with self.assertRaisesRegex(ValueError, "failed \\(500\\).*ZeroDivisionError"):
+                client.request("/rules", {"reactions": ["R00000"]})
+        self.assertIs(client.connection.sock, sock)
+        self.assertEqual(client.rules(["R01518"]), {"R01518": self.combined["R01518"]})
+        client.close()
+
+    def test_malformed_request_line(self):
+        with socket.create_connection(("127.0.0.1", self.port), timeout=10) as sock:
+            sock.sendall(b"GARBAGE\r\n\r\n")
+            response = b""
+            while chunk := sock.recv(4096):
+                response += chunk
+        head, _, body = response.partition(b"\r\n\r\n")
+        self.assertTrue(head.startswith(b"HTTP/1.1 400"))
+        self.assertEqual(json.loads(body), {"error": "malformed request"})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+import sys
+sys.path.append("..")
+from kegg_rules.spreadsheet import parse_rule, parse_rule_rows, read_rule_sheet, RuleSyntaxError
+
+def fs(*kos):
+    return frozenset(kos)
+
+class TestParseRule(unittest.TestCase):
+    def test_flat(self):
+        self.assertEqual(parse_rule("K00001+K00002,K00003"), {fs("K00001", "K00002"), fs("K00003")})
+        self.assertEqual(parse_rule(" K00001 + K00002, K00003 "), {fs("K00001", "K00002"), fs("K00003")})
+
+    def test_parentheses(self):
+        self.assertEqual(parse_rule("K00001+(K00002,K00003)"), {fs("K00001", "K00002"), fs("K00001", "K00003")})
+        self.assertEqual(parse_rule("(K00001,K00002)+(K00003,K00004+K00005)"),
+                         {fs("K00001", "K00003"), fs("K00001", "K00004", "K00005"),
+                          fs("K00002", "K00003"), fs("K00002", "K00004", "K00005")})
+        self.assertEqual(parse_rule("((K00001))"), {fs("K00001")})
+
+    def test_interned(self):
+        a, = next(iter(parse_rule("K0000" + "1")))
+        b, = next(iter(parse_rule("(K00001)")))
+        self.assertIs(a, b)
+
+    def test_errors(self):
+        for rule in ["", " ", "K00001+", "K00001,,K00002", "(K00001", "K00001)", "K00001 K00002", "K00001;K00002"]:
+            with self.assertRaises(RuleSyntaxError, msg=rule):
+                parse_rule(rule)
+
+class TestParseRuleRows(unittest.TestCase):
+    def test_report(self):
+        keys = ["R1", "R2", None, "R3", "R4", "R5", "R5"]
+        rules = ["K00001", float("nan"), "K00002", "K00003+", "K0004+K00005", "K00006", "K00007"]
+        rules_out, issues = parse_rule_rows(keys, rules)
+        self.assertEqual(rules_out, {"R1": {fs("K00001")}, "R4": {fs("K0004", "K00005")}, "R5": {fs("K00007")}})
+        self.assertEqual(issues["row"].tolist(), [3, 4, 5, 6, 7])
+        self.assertEqual(issues["rejected"].tolist(), [True, True, True, False, True])
+        self.assertEqual(issues["issue"].tolist()[:2], ["missing rule", "missing reaction"])
+        self.assertTrue(issues["issue"][2].startswith("syntax error"))
+        self.assertEqual(issues["issue"][3], "unusual KO ID: K0004")
+        self.assertEqual(issues["issue"][4], "overridden by row 8")
+
+    def test_read_rule_sheet(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sheet.csv")
+            with open(path, "w") as f:
+                f.write('rn,rule,ko_list,notes\nR1,K00001+K00002,"K00001,K00002","long\ntext"\nR2,K00003,NA,\n')
+            rules, issues = read_rule_sheet(path, "rn", "rule")
+            self.assertEqual(rules, {"R1": {fs("K00001", "K00002")}, "R2": {fs("K00003")}})
+            self.assertEqual(len(issues), 0)
+            rules, _ = read_rule_sheet(path, "rn", "rule", where=lambda df: df.ko_list.notna(), extra_cols=["ko_list"])
+            self.assertEqual(list(rules), ["R1"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import pickle
+import tempfile
+import unittest
+import sys
+import pandas as pd
+sys.path.append("..")
+from kegg_rules.evaluate import ModuleCompleteness, ReactionFeasibility
+from kegg_rules.stream import iter_ko_profiles, evaluate_stream
+
+class TestStream(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_kofamscan(self):
+        path = self.write("g1.txt", "g1_1\tK00031\ng1_2\ng1_3\tK00382\n")
+        self.assertEqual(list(iter_ko_profiles(path, "kofamscan")), [("g1", {"K00031", "K00382"})])
+
+    def test_kofamscan_detail(self):
+        path = self.write("g1.txt", "# gene name\tKO\tthrshld\tscore\tE-value\tKO definition\n"
+                                    "#---------\t------\n"
+                                    "* g1_1  K00031  400.0  500.1  1e-100 isocitrate dehydrogenase\n"
+                                    "  g1_1  K00030  400.0  100.1  1e-10 isocitrate dehydrogenase (NAD+)\n")
+        self.assertEqual(list(iter_ko_profiles(path, "kofamscan-detail")), [("g1", {"K00031"})])
+
+    def test_kofamscan_detail_genome_of(self):
+        path = self.write("all.txt", "# gene name\tKO\tthrshld\tscore\tE-value\tKO definition\n"
+                                     "* g1_1  K00031  400.0  500.1  1e-100 isocitrate dehydrogenase\n"
+                                     "  g1_1  K00030  400.0  100.1  1e-10 isocitrate dehydrogenase (NAD+)\n"
+                                     "  g1_2  K00030  400.0  100.1  1e-10 isocitrate dehydrogenase (NAD+)\n"
+                                     "  g2_1  K00030  400.0  100.1  1e-10 isocitrate dehydrogenase (NAD+)\n"
+                                     "* g2_1  K00031  400.0  500.1  1e-100 isocitrate dehydrogenase\n")
+        profiles = list(iter_ko_profiles(path, "kofamscan-detail", genome_of=lambda gene: gene.split("_")[0]))
+        self.assertEqual(profiles, [("g1", {"K00031"}), ("g2", {"K00031"})])
+
+    def test_eggnog(self):
+        path = self.write("g1.emapper.annotations",
+                          "## emapper-2.1.6\n## time\n#query\tseed_ortholog\tKEGG_ko\tPFAMs\n"
+                          "g1_1\tx\tko:K00031,ko:K00030\tp\ng1_2\tx\t-\tp\n## 2 queries scanned\n")
+        self.assertEqual(list(iter_ko_profiles(path, "eggnog")), [("g1", {"K00031", "K00030"})])
+
+    def test_tabular_across_chunks_and_files(self):
+        a = self.write("a.tsv", "genome\tgene\tko\nA\ta1\tK1\nA\ta2\tK2\nB\tb1\tK1\nB\tb2\t\nC\tc1\t\n")
+        b = self.write("b.tsv", "genome\tgene\tko\nD\td1\tK3\n")
+        profiles = list(iter_ko_profiles([a, b], "tabular", chunksize=1))
+        self.assertEqual(profiles, [("A", {"K1", "K2"}), ("B", {"K1"}), ("C", set()), ("D", {"K3"})])
+        by_gene = list(iter_ko_profiles(a, "tabular", genome_col=None, genome_of=lambda gene: gene[0].upper()))
+        self.assertEqual(by_gene[0], ("A", {"K1", "K2"}))
+
+    def test_tabular_genome_of_without_genome_column(self):
+        path = self.write("a.tsv", "gene\tko\na1\tK1\nb1\tK2\n")
+        profiles = list(iter_ko_profiles(path, "tabular", genome_of=lambda gene: gene[0].upper()))
+        self.assertEqual(profiles, [("A", {"K1"}), ("B", {"K2"})])
+
+    def test_not_contiguous(self):
+        path = self.write("a.tsv", "genome\tko\nA\tK1\nB\tK1\nA\tK2\n")
+        with self.assertRaises(ValueError):
+            list(iter_ko_profiles(path, "tabular", chunksize=2))
+
+    def test_evaluate_stream(self):
+        with open("../module_ko_to_rn/assets/calculated_module_dict.pkl", 'rb') as f:
+            modules = ModuleCompleteness(pickle.load(f))
+        with open("../mapping/final_map/v3/rn2ko_map_combined.pkl", 'rb') as f:
+            reactions = ReactionFeasibility(pickle.load(f))
+        rows = ["genome\tko"] + ["G%d\t%s" % (i, ko) for i in range(5) for ko in sorted(modules.sets.sets[i * 50] | {"K00031"})]
+        path = self.write("a.tsv", "\n".join(rows) + "\n")
+        genomes = dict(iter_ko_profiles(path, "tabular"))
+
+        modules_OUTPATH = os.path.join(self.tmp.name, "modules.tsv")
+        reactions_OUTPATH = os.path.join(self.tmp.name, "reactions.tsv")
+        n = evaluate_stream(iter_ko_profiles(path, "tabular", chunksize=3), modules, reactions, modules_OUTPATH, reactions_OUTPATH,
+                            batch_size=2, best_sets=True)
+        self.assertEqual(n, 5)
+
+        completeness, best = modules.evaluate_genomes(genomes)
+        written = pd.read_csv(modules_OUTPATH, sep="\t", index_col="genome")
+        self.assertEqual(list(written.index), list(genomes))
+        pd.testing.assert_frame_equal(written.astype(float), completeness.astype(float), check_names=False, atol=1e-3)
+        best_written = pd.read_csv(modules_OUTPATH + ".best.tsv", sep="\t", index_col="genome")
+        self.assertEqual(best_written.loc["G0", modules.modules[0]], "+".join(sorted(best.loc["G0", modules.modules[0]])))
+
+        feasible = reactions.evaluate_genomes(genomes)
+        written = pd.read_csv(reactions_OUTPATH, sep="\t", index_col="genome")
+        self.assertTrue((written.values.astype(bool) == feasible.values).all())
+
+if __name__ == '__main__':
+    unittest.main()
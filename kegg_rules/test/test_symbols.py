@@ -0,0 +1,62 @@
+import unittest
+import sys
+sys.path.append("..")
+from kegg_rules.symbols import SymbolTable, RuleSetPool, is_subset
+
+class TestSymbolTable(unittest.TestCase):
+    def test_encode_is_dense_and_stable(self):
+        symbols = SymbolTable()
+        self.assertEqual([symbols.encode(k) for k in ["K00001", "K00002", "K00001"]], [0, 1, 0])
+        self.assertEqual(symbols.encode("R00001", kind="rn"), 0) ## Kinds are numbered separately
+        self.assertEqual(symbols.decode(1), "K00002")
+        self.assertEqual(len(symbols), 3)
+
+    def test_mask_roundtrip(self):
+        symbols = SymbolTable()
+        fs = frozenset(["K00031", "K00030", "K01899"])
+        self.assertEqual(symbols.unmask(symbols.mask(fs)), fs)
+        self.assertEqual(symbols.unmask(0), frozenset())
+
+    def test_set_algebra(self):
+        symbols = SymbolTable()
+        a = symbols.mask(["K1", "K2"])
+        b = symbols.mask(["K1", "K2", "K3"])
+        self.assertTrue(is_subset(a, b))
+        self.assertFalse(is_subset(b, a))
+        self.assertEqual(symbols.unmask(a | symbols.mask(["K4"])), frozenset(["K1", "K2", "K4"]))
+        self.assertEqual(symbols.unmask(b & symbols.mask(["K3", "K5"])), frozenset(["K3"]))
+
+    def test_rules_roundtrip(self):
+        symbols = SymbolTable()
+        rules = {"R00267": {frozenset(["K00031"]), frozenset(["K00030"])},
+                 "R00405": {frozenset(["K01903", "K01902"]), frozenset(["K01899", "K01900"])}}
+        encoded = symbols.encode_rules(rules)
+        self.assertTrue(all(isinstance(m, int) for ruleset in encoded.values() for m in ruleset))
+        self.assertEqual(symbols.decode_rules(encoded), rules)
+        self.assertEqual(symbols.unmask(symbols.encode_links({"R1": ["K00031", "K9"]})["R1"]), frozenset(["K00031", "K9"]))
+
+class TestRuleSetPool(unittest.TestCase):
+    def test_equal_sets_are_shared(self):
+        pool = RuleSetPool()
+        a = pool.intern(["K00844", "K".join(["", "00845"])])
+        b = pool.intern(frozenset(["K00845", "K00844"]))
+        self.assertIs(a, b)
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.requested, 2)
+        c = pool.intern(["K00845"])
+        self.assertIs(next(iter(c)), [ko for ko in a if ko == "K00845"][0]) ## KO strings are shared too
+
+    def test_maps(self):
+        pool = RuleSetPool()
+        maps = {"a": {"R1": {frozenset(["K1"])}, "R2": {frozenset(["K1"]), frozenset(["K2", "K3"])}},
+                "b": {"R1": {frozenset(["K1"])}},
+                "c": None}
+        interned = pool.maps(maps)
+        self.assertEqual(interned, maps)
+        self.assertEqual(len(pool), 2)
+        self.assertIs(next(iter(interned["a"]["R1"])), next(iter(interned["b"]["R1"])))
+        self.assertIsNot(interned["a"]["R1"], interned["b"]["R1"]) ## Rulesets themselves aren't shared
+        self.assertIsNot(interned["a"]["R1"], maps["a"]["R1"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import csv
+import tempfile
+import unittest
+import importlib.util
+import sys
+sys.path.append("..")
+from kegg_rules.tables import write_rules_table, read_rules_table, iter_rule_rows
+
+MAPS = {"map_b": {"R2": {frozenset(["K3", "K1"]), frozenset(["K2"])}, "R1": {frozenset(["spontaneous"])}},
+        "map_a": {"R3": {frozenset(["K9"])}},
+        "map_none": None}
+
+class TestTables(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_rows_sorted(self):
+        self.assertEqual(list(iter_rule_rows(MAPS)),
+                         [("R3", "map_a", ["K9"]), ("R1", "map_b", ["spontaneous"]),
+                          ("R2", "map_b", ["K1", "K3"]), ("R2", "map_b", ["K2"])])
+
+    def test_csv_roundtrip(self):
+        path = os.path.join(self.tmp.name, "maps.csv")
+        write_rules_table(path, MAPS, chunksize=2)
+        with open(path, newline="") as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], ["reaction", "origin", "rule"])
+        self.assertEqual(rows[3], ["R2", "map_b", "K1+K3"])
+        self.assertEqual(read_rules_table(path), {o: m for o, m in MAPS.items() if m is not None})
+
+    @unittest.skipIf(importlib.util.find_spec("pyarrow") is None, "pyarrow not installed")
+    def test_parquet_roundtrip(self):
+        path = os.path.join(self.tmp.name, "maps.parquet")
+        write_rules_table(path, MAPS, key_col="module", chunksize=2)
+        self.assertEqual(read_rules_table(path, key_col="module"), {o: m for o, m in MAPS.items() if m is not None})
+
+    @unittest.skipIf(importlib.util.find_spec("pyarrow") is not None, "pyarrow installed")
+    def test_parquet_needs_pyarrow(self):
+        with self.assertRaisesRegex(ImportError, "pyarrow"):
+            write_rules_table(os.path.join(self.tmp.name, "maps.parquet"), MAPS)
+
+if __name__ == "__main__":
+    unittest.main()
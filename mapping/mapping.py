@@ -7,6 +7,18 @@ import json
 import pprint
 import itertools
 import os
+import sys
+import hashlib
+import functools
+import threading
+import concurrent.futures
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from kegg_rules.symbols import SymbolTable, RuleSetPool
+from kegg_rules.rulefile import write_rule_map, write_rule_maps
+from kegg_rules.keywords import KeywordTagger
+from kegg_rules.tables import write_rules_csv, write_rules_parquet
+from kegg_rules import spreadsheet
+from kegg_rules.diff import diff_maps, summarize_diff, load_maps
 
 """
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -46,6 +58,7 @@ WRITE-OUT FUNCTIONS FOR POST-MAPPING:
 - dump_maps_by_type
 - dump_maps_combined
 - dump_maps_to_csv
+- dump_maps_to_parquet
 
 CORE PIPELINE FUNCTIONS TO GENERATE MAPS:
 - generate_all_maps
@@ -125,6 +138,93 @@ def write_links(links_path = "../mydata/links"):
         json.dump(rn_to_mo_dict, f, default=serialize_sets)
 
 
+class InputCache:
+    """
+    Pickled results of parsing input files (and of state derived from them), reused while the files are unchanged.
+
+    Each entry records its file's mtime, size and sha256. An entry is reused without rehashing while mtime and
+    size match, and after rehashing if only the mtime changed; otherwise the file is parsed again. Derived
+    state is stored under the sha256s of the files it came from.
+
+    :param cache_dir: directory holding the cache entries, created if needed
+    """
+    VERSION = 1 ## Bump when the cached objects change shape
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.digests = dict() ## path -> sha256 of files loaded through this cache
+        self.reused = []
+        self.rebuilt = []
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def sha256(path):
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def entry_path(self, tag, key):
+        return os.path.join(self.cache_dir, "%s-%s.pkl" % (tag, hashlib.sha256(key.encode()).hexdigest()[:16]))
+
+    def read_entry(self, path):
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+            return entry if entry.get("version") == self.VERSION else None
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            return None ## Missing, or left half-written by an interrupted run
+
+    def write_entry(self, path, entry):
+        entry["version"] = self.VERSION
+        tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, path, parse, tag):
+        """`parse(path)`, or its cached result if the file hasn't changed since"""
+        entry_path = self.entry_path(tag, os.path.abspath(path))
+        entry = self.read_entry(entry_path)
+        st = os.stat(path)
+        stat = (st.st_mtime_ns, st.st_size)
+        if entry is not None and entry["stat"] == stat:
+            self.digests[path] = entry["sha256"]
+            self.reused.append(tag)
+            return entry["value"]
+
+        digest = self.sha256(path)
+        self.digests[path] = digest
+        if entry is not None and entry["sha256"] == digest: ## Touched, but same content
+            entry["stat"] = stat
+            self.write_entry(entry_path, entry)
+            self.reused.append(tag)
+            return entry["value"]
+
+        value = parse(path)
+        self.write_entry(entry_path, {"stat": stat, "sha256": digest, "value": value})
+        self.rebuilt.append(tag)
+        return value
+
+    def digest(self, path):
+        """sha256 of a file, reusing the one found while loading it"""
+        if path not in self.digests:
+            self.digests[path] = self.sha256(path)
+        return self.digests[path]
+
+    def derive(self, tag, paths, compute):
+        """`compute()`, or its cached result for the same contents of `paths`"""
+        entry_path = self.entry_path(tag, "|".join(self.digest(path) for path in paths))
+        entry = self.read_entry(entry_path)
+        if entry is not None:
+            self.reused.append(tag)
+            return entry["value"]
+        value = compute()
+        self.write_entry(entry_path, {"value": value})
+        self.rebuilt.append(tag)
+        return value
+
 class Mapping:
     """
     Main class used to do mapping
@@ -137,28 +237,29 @@ class Mapping:
     :param module_entries_path: path to downloaded module entries file 
     :param reaction_entries_path: path to downloaded reaction entries file 
     :param links_path: path to the downloaded links directory
+    :param cache_dir: directory for the startup cache of parsed inputs (see InputCache), None to disable it
     """
 
     def __init__(self,
                  module_entries_path = "module_ko_to_rn/assets/module_entry_dict-2021_03_22.json",
                  reaction_entries_path = "../mydata/reaction.json",
-                 links_path = "../mydata/links"):
+                 links_path = "../mydata/links",
+                 cache_dir = ".mapping_cache"):
+
+        ## Parsed inputs and derived state are reused from `cache_dir` while the input files are unchanged
+        self.cache = InputCache(cache_dir) if cache_dir else None
 
-        ## KEGG entries
-        self.module_entry_dict = self.load_json_into_dict(module_entries_path)
-        self.reaction_entry_dict = self.load_json_into_dict(reaction_entries_path)
+        ## Dense integer ids for KOs, shared by the bitmask-based mappings
+        self.symbols = SymbolTable()
 
-        ## Links inferred from KEGG
-        self.mo_to_ko_dict = {k:set(vlist) for k,vlist in self.load_json_into_dict(os.path.join(links_path,"mo_to_ko_dict.json")).items()}
-        self.mo_to_rn_dict = {k:set(vlist) for k,vlist in self.load_json_into_dict(os.path.join(links_path,"mo_to_rn_dict.json")).items()}
-        self.rn_to_ko_dict = {k:set(vlist) for k,vlist in self.load_json_into_dict(os.path.join(links_path,"rn_to_ko_dict.json")).items()}
-        self.rn_to_mo_dict = {k:set(vlist) for k,vlist in self.load_json_into_dict(os.path.join(links_path,"rn_to_mo_dict.json")).items()}
+        ## Every stage's KO sets go through one pool, so equal sets in different maps are one object.
+        ## The pool isn't thread safe; generate_all_maps only interns on the calling thread
+        self.rule_pool = RuleSetPool()
 
-        ## Modules and reactions from modules with addition in definition (e.g. K00001+K00002)
-        self.plusmodules, self.noplusmodules = self.set_plusmodules(self.module_entry_dict)
-        self.rsetinplusmodules2plus = None ## Maps to at least one KO
-        self.rsetinplusmodules1minus = None ## Maps to at least one KO
-        self.get_rsets_in_plusmodules() ## Sets above two vars
+        ## KEGG entries and links inferred from KEGG are loaded on first use (see the properties below)
+        self.module_entries_path = module_entries_path
+        self.reaction_entries_path = reaction_entries_path
+        self.link_paths = {name: os.path.join(links_path, name+".json") for name in ["mo_to_ko_dict", "mo_to_rn_dict", "rn_to_ko_dict", "rn_to_mo_dict"]}
 
         self.rn_to_ko_not_in_modules = None
 
@@ -183,6 +284,7 @@ class Mapping:
 
         ## Read CSVs that were manually mapped
         self.csvs_mapped = dict()
+        self.spreadsheet_issues = dict() ## map name -> rejected or suspicious rows (see kegg_rules.spreadsheet)
 
     @staticmethod
     def load_json_into_dict(path):
@@ -191,25 +293,115 @@ class Mapping:
             mydict = json.load(f)
         return mydict
 
+    @classmethod
+    def load_link_dict(cls, path):
+        """Load links written by `write_links`, with the lists of linked IDs as sets"""
+        return {k:set(vlist) for k,vlist in cls.load_json_into_dict(path).items()}
+
+    def load_input(self, path, parse, tag):
+        """`parse(path)`, through the startup cache if there is one"""
+        if self.cache is None:
+            return parse(path)
+        return self.cache.load(path, parse, tag)
+
+    ## Inputs are parsed the first time they're used, so stages only pay for the files they need
+    @functools.cached_property
+    def module_entry_dict(self):
+        return self.load_input(self.module_entries_path, self.load_json_into_dict, "module_entries")
+
+    @functools.cached_property
+    def reaction_entry_dict(self):
+        return self.load_input(self.reaction_entries_path, self.load_json_into_dict, "reaction_entries")
+
+    @functools.cached_property
+    def mo_to_ko_dict(self):
+        return self.load_input(self.link_paths["mo_to_ko_dict"], self.load_link_dict, "mo_to_ko_dict")
+
+    @functools.cached_property
+    def mo_to_rn_dict(self):
+        return self.load_input(self.link_paths["mo_to_rn_dict"], self.load_link_dict, "mo_to_rn_dict")
+
+    @functools.cached_property
+    def rn_to_ko_dict(self):
+        return self.load_input(self.link_paths["rn_to_ko_dict"], self.load_link_dict, "rn_to_ko_dict")
+
+    @functools.cached_property
+    def rn_to_mo_dict(self):
+        return self.load_input(self.link_paths["rn_to_mo_dict"], self.load_link_dict, "rn_to_mo_dict")
+
+    ## Modules and reactions from modules with addition in definition (e.g. K00001+K00002)
+    @functools.cached_property
+    def plusmodule_state(self):
+        """(plusmodules, noplusmodules, rsetinplusmodules2plus, rsetinplusmodules1minus), cached with the inputs"""
+        def compute():
+            self.plusmodules, self.noplusmodules = self.set_plusmodules(self.module_entry_dict)
+            self.get_rsets_in_plusmodules() ## Sets self.rsetinplusmodules2plus, self.rsetinplusmodules1minus
+            return self.plusmodules, self.noplusmodules, self.rsetinplusmodules2plus, self.rsetinplusmodules1minus
+
+        if self.cache is None:
+            return compute()
+        return self.cache.derive("plusmodules", [self.module_entries_path, self.link_paths["mo_to_rn_dict"], self.link_paths["rn_to_ko_dict"]], compute)
+
+    @functools.cached_property
+    def plusmodules(self):
+        return self.plusmodule_state[0]
+
+    @functools.cached_property
+    def noplusmodules(self):
+        return self.plusmodule_state[1]
+
+    @functools.cached_property
+    def rsetinplusmodules2plus(self):
+        return self.plusmodule_state[2] ## Maps to at least 1 KO
+
+    @functools.cached_property
+    def rsetinplusmodules1minus(self):
+        return self.plusmodule_state[3] ## Maps to at least 1 KO
+
+    ## Keywords looked for (case-insensitive) in reaction comments and in the descriptions of a reaction's orthologs
+    COMMENT_KEYWORDS = ["spontaneous", "non enzymatic", "non-enzymatic", "nonenzymatic", "multi step", "multi-step", "multistep"]
+    SPONTANEOUS_KEYWORDS = ["spontaneous", "non enzymatic", "non-enzymatic", "nonenzymatic"]
+    ORTHOLOGY_KEYWORDS = ["effector", "anchor", "auxiliary", "carrier", "pts", "subunit", "chain", "reductase component"]
+
+    @functools.cached_property
+    def reaction_keywords(self):
+        """
+        Reaction x keyword bool table of every reaction entry, with ("comment", keyword) columns for
+        COMMENT_KEYWORDS and ("orthologs", keyword) columns for ORTHOLOGY_KEYWORDS (in any of its orthologs).
+        Each field is scanned once for all of its keywords.
+        """
+        comment_tagger = KeywordTagger(self.COMMENT_KEYWORDS)
+        ortholog_tagger = KeywordTagger(self.ORTHOLOGY_KEYWORDS)
+        comments = {r:v.get("comment", "") for r,v in self.reaction_entry_dict.items()}
+        ## Keywords have no newlines, so joining on them can't make matches across orthologs
+        orthologs = {r:"\n".join(v.get("orthologs", dict()).values()) for r,v in self.reaction_entry_dict.items()}
+        return pd.concat({"comment": comment_tagger.tag_all(comments), "orthologs": ortholog_tagger.tag_all(orthologs)}, axis=1)
+
     def parse_spreadsheet_rules(self,rns_rules,rn_col="Reaction",rule_col="Rule",verbose=False):
-        """Read manually mapped spreadsheet into dict which can be used to make df"""
-        rules_formatted = dict()
-        for d in rns_rules:
-            try:
-                rules_formatted[d[rn_col]] = self.parse_rule(d[rule_col])
-            except: 
-                if verbose:
-                    print(d)
+        """Read manually mapped spreadsheet into dict which can be used to make df. Bad rows are printed if verbose"""
+        rules_formatted, issues = spreadsheet.parse_rule_rows([d[rn_col] for d in rns_rules], [d[rule_col] for d in rns_rules])
+        if verbose and len(issues):
+            print(issues.to_string(index=False))
         return rules_formatted
 
+    def read_spreadsheet_rules(self, map_name, path, rn_col="Reaction", rule_col="Rule", **kwargs):
+        """
+        Read only the reaction and rule columns of a manually mapped spreadsheet into `self.maps[map_name]`.
+        Rows that were rejected or look wrong go to `self.spreadsheet_issues[map_name]`.
+
+        :param kwargs: passed to kegg_rules.spreadsheet.read_rule_sheet (where, extra_cols)
+        """
+        self.maps[map_name], issues = spreadsheet.read_rule_sheet(path, rn_col, rule_col, **kwargs)
+        self.spreadsheet_issues[map_name] = issues
+        if len(issues):
+            counts = issues.groupby("rejected").size()
+            print("%s: %d rows rejected, %d kept with warnings (see Mapping.spreadsheet_issues)"
+                  % (map_name, counts.get(True, 0), counts.get(False, 0)))
+
     @staticmethod
     def parse_rule(rule):
-        """Parse a single rule from the manually mapped spreadsheet into sets of frozensets"""
-        or_rules = rule.split(",")
-        all_ands = set()
-        for r in or_rules:
-            all_ands.add(frozenset(r.split("+")))
-        return set(all_ands)  
+        """Parse a single rule from the manually mapped spreadsheet into sets of frozensets (e.g. "K00001+(K00002,K00003)")"""
+        return spreadsheet.parse_rule(rule)
 
     @staticmethod
     def set_plusmodules(module_entry_dict):
@@ -258,25 +450,19 @@ class Mapping:
         """
         1.1 Reactions found in any modules not containing addition rules
         """
-        rn_to_ko_noplusmodules = dict()
-        rn_to_ko_noplusmodules_koinmodule = dict()
+        ## KOs are handled as bitmasks from self.symbols, so each module is one `&` per reaction
+        rn_to_ko_masks = self.symbols.encode_links(self.rn_to_ko_dict)
+        mo_to_ko_masks = self.symbols.encode_links(self.mo_to_ko_dict)
 
+        rn_to_ko_noplusmodules_koinmodule = dict()
         for m in self.noplusmodules:
             if m in self.mo_to_rn_dict:
                 for r in self.mo_to_rn_dict[m]:
-                    if r in self.rn_to_ko_dict:
-                        if r in rn_to_ko_noplusmodules:
-                            rn_to_ko_noplusmodules[r] |= copy.copy(self.rn_to_ko_dict[r])
-                        else:
-                            rn_to_ko_noplusmodules[r] = copy.copy(self.rn_to_ko_dict[r])
-                        
-                        if r in rn_to_ko_noplusmodules_koinmodule:
-                            rn_to_ko_noplusmodules_koinmodule[r] |= copy.copy({k for k in self.rn_to_ko_dict[r] if k in self.mo_to_ko_dict[m]})
-                        else:
-                            rn_to_ko_noplusmodules_koinmodule[r] =  {k for k in self.rn_to_ko_dict[r] if k in self.mo_to_ko_dict[m]}
-
-        rn_to_ko_noplusmodules_koinmodule = {r:kset for r,kset in rn_to_ko_noplusmodules_koinmodule.items() if len(kset)>0} ## Make sure at least 1 ko
-        self.maps["map_rn2ko_viaMO_noaddition"] = {r:{frozenset([k]) for k in kset} for r,kset in rn_to_ko_noplusmodules_koinmodule.items()} ## Format with frozensets
+                    if r in rn_to_ko_masks:
+                        rn_to_ko_noplusmodules_koinmodule[r] = rn_to_ko_noplusmodules_koinmodule.get(r, 0) | (rn_to_ko_masks[r] & mo_to_ko_masks[m])
+
+        self.maps["map_rn2ko_viaMO_noaddition"] = {r:{frozenset([k]) for k in self.symbols.unmask(kmask)} 
+                                                   for r,kmask in rn_to_ko_noplusmodules_koinmodule.items() if kmask} ## Make sure at least 1 ko; format with frozensets
 
     ##########################################################################################
     ## 1.2 Reactions found in any modules containing addition rules
@@ -357,9 +543,7 @@ class Mapping:
 
         :param path: path to manually mapped CSV
         """
-        spreadsheet = pd.read_csv(path, index_col=False)
-        rns_rules = spreadsheet[["Reaction","Rule"]].to_dict(orient="records")
-        self.maps["map_rn2ko_viaMO_addition2plus"] = self.parse_spreadsheet_rules(rns_rules)
+        self.read_spreadsheet_rules("map_rn2ko_viaMO_addition2plus", path)
 
     ##########################################################################################
     ## 2 Reactions which CANNOT be directly associated with modules via the KEGG API, but
@@ -392,30 +576,17 @@ class Mapping:
         ## TODO: Add keyword as part of this initial function
 
         self.get_rn_to_ko_not_in_modules()
+        ortholog_keywords = self.reaction_keywords["orthologs"]
         listdf = []
         
         for r, kos in {k:v for k,v in self.rn_to_ko_not_in_modules.items() if len(v)>1}.items():  
             ofield = self.reaction_entry_dict[r]["orthologs"]
-            _kw_dict = copy.copy({"effector":False,
-                                "anchor":False,
-                                "auxiliary":False,
-                                "carrier":False,
-                                "pts":False,
-                                "subunit":False,
-                                "chain":False,
-                                "reductase component":False})
+            _kw_dict = {keyword:bool(found) for keyword, found in ortholog_keywords.loc[r].items()}
             _dict = dict()
             _dict["Reaction"] = r
             _dict["url"] = "https://www.genome.jp/dbget-bin/www_bget?rn:"+r
             _dict["KOs"] = ",".join(kos)
 
-            for k,txt in ofield.items():
-                txtlower = txt.lower()
-
-                for keyword in _kw_dict:
-                    if keyword in txtlower:
-                        _kw_dict[keyword] = True
-
             _kw_dict["orthology"] = pprint.pformat(ofield) ## Format orthology
             _dict |= _kw_dict ## Add _kw_dict to _dict
             listdf.append(_dict)
@@ -435,9 +606,7 @@ class Mapping:
         :param path: path to manually mapped CSV       
         """
 
-        spreadsheet = pd.read_csv(path,index_col=False)
-        rns_rules = spreadsheet[["Reaction","Rule"]].to_dict(orient="records")
-        self.maps["map_rn2ko_viaKO_2plus"] = self.parse_spreadsheet_rules(rns_rules)    
+        self.read_spreadsheet_rules("map_rn2ko_viaKO_2plus", path)
 
     ##########################################################################################
     ## 3 Reactions which CANNOT be directly associated with modules via the KEGG API, AND
@@ -447,7 +616,7 @@ class Mapping:
     ## 3.1 Reactions that map to ECs that only map to 1 KO
     ## 3.2 Reactions that map to ECs that map to >1 KO
     ## NOTE: THIS DATA WAS ORIGINALLY GENERATED BY JOSH, SO I DON'T HAVE THE SCRIPT WE USED TO MAKE THESE SHEETS.
-    def to_csv_rn2ko_viaEC_1minus(self):
+    def to_csv_rn2ko_viaEC_1minus(self, OUTPATH=None):
         """
         3.1 Reactions that map to ECs that only map to 1 KO
         """
@@ -457,11 +626,9 @@ class Mapping:
         """
         3.1 Reactions that map to ECs that only map to 1 KO
         """
-        spreadsheet = pd.read_csv(path, index_col=False)
-        rns_rules = spreadsheet[["rn","ko_list"]].to_dict(orient="records")
-        self.maps["map_rn2ko_viaEC_1minus"] = self.parse_spreadsheet_rules(rns_rules,rn_col="rn",rule_col="ko_list")
+        self.read_spreadsheet_rules("map_rn2ko_viaEC_1minus", path, rn_col="rn", rule_col="ko_list")
 
-    def to_csv_rn2ko_viaEC_2plus(self):
+    def to_csv_rn2ko_viaEC_2plus(self, OUTPATH=None):
         """
         3.2 (PRE-MAPPING) Reactions that map to ECs that map to >1 KO
         
@@ -477,10 +644,8 @@ class Mapping:
 
         :param path: path to manually mapped CSV   
         """
-        spreadsheet = pd.read_csv(path, index_col=False)
-        spreadsheet = spreadsheet[spreadsheet.ko_list != "NA"]
-        rns_rules = spreadsheet[["rn","rule"]].to_dict(orient="records")
-        self.maps["map_rn2ko_viaEC_2plus"] = self.parse_spreadsheet_rules(rns_rules,rn_col="rn",rule_col="rule")
+        self.read_spreadsheet_rules("map_rn2ko_viaEC_2plus", path, rn_col="rn", rule_col="rule",
+                                    where=lambda df: df.ko_list != "NA", extra_cols=["ko_list"])
 
     ##########################################################################################
     ## 4 Reactions which can happen spontaneously
@@ -500,27 +665,11 @@ class Mapping:
         which may have said something like, "not spontanteous" (no instances of this were found and our full 
         automatically identified list was used). 
         """
-        keyword_rn_dict = {"spontaneous":dict(),
-                    "non enzymatic":dict(),
-                    "non-enzymatic":dict(),
-                    "nonenzymatic":dict(),
-                    "multi step":dict(),
-                    "multi-step":dict(),
-                    "multistep":dict()}
-        
-        for r,v in self.reaction_entry_dict.items():
-            comment = v["comment"].lower()   
-            for k in keyword_rn_dict:
-                if k in comment:
-                    keyword_rn_dict[k][r] = copy.copy(comment)
-
-        spontaneous_rns = {**keyword_rn_dict["spontaneous"],
-            **keyword_rn_dict["non enzymatic"],
-            **keyword_rn_dict["non-enzymatic"],
-            **keyword_rn_dict["nonenzymatic"]}
-
-        for r in spontaneous_rns:
-            spontaneous_rns[r] = {frozenset(["spontaneous"])}
+        comment_keywords = self.reaction_keywords["comment"]
+        spontaneous_rns = dict()
+        for keyword in self.SPONTANEOUS_KEYWORDS:
+            for r in comment_keywords.index[comment_keywords[keyword]]:
+                spontaneous_rns.setdefault(r, {frozenset(["spontaneous"])})
 
         self.maps["map_rn2ko_spontaneous"] = spontaneous_rns
 
@@ -564,56 +713,209 @@ class Mapping:
         pickle.dump(maps, open(OUTPATH, 'wb'))
 
     @staticmethod
-    def dump_maps_combined(maps, OUTPATH = "final_map/rn2ko_map_combined.pkl"):
-        ## Combined
+    def combine_maps(maps):
+        """
+        Union of every map's rules for each reaction.
+
+        Built by reference: a reaction in a single map shares that map's ruleset, and a reaction in several
+        gets a new union, so the maps themselves are never modified. Copy a ruleset before changing it.
+        """
         combined_dict_of_rules = dict()
         for d, rn_to_ko_dict in maps.items():
+            if rn_to_ko_dict is None:
+                continue
             for r, kset in rn_to_ko_dict.items():
                 if r in combined_dict_of_rules:
-                    combined_dict_of_rules[r] |= copy.copy(kset)
+                    combined_dict_of_rules[r] = combined_dict_of_rules[r] | kset
                 else:
-                    combined_dict_of_rules[r] = copy.copy(kset)
+                    combined_dict_of_rules[r] = kset
+        return combined_dict_of_rules
 
-        pickle.dump(combined_dict_of_rules, open(OUTPATH, 'wb'))
+    @classmethod
+    def dump_maps_combined(cls, maps, OUTPATH = "final_map/rn2ko_map_combined.pkl"):
+        ## Combined
+        pickle.dump(cls.combine_maps(maps), open(OUTPATH, 'wb'))
+
+    @classmethod
+    def dump_maps_to_rulefile(cls, maps, OUTPATH = "final_map/rn2ko_map_by_type.rules", combined = False):
+        """
+        Write maps to a flat rule file (see kegg_rules.rulefile), one origin per map type.
+        With combined=True, writes the combined map instead, as a single "combined" origin.
+        """
+        if combined:
+            write_rule_map(OUTPATH, cls.combine_maps(maps), origin="combined")
+        else:
+            write_rule_maps(OUTPATH, maps)
 
     @staticmethod
     def dump_maps_to_csv(maps, OUTPATH = "final_map/rn2ko_map_by_type.csv"):
-        ## Spreadsheet; could clean up using pd.pipe maybe
-        rules_df = pd.DataFrame.from_dict(maps).reset_index()
-        rules_df.rename(columns={"index": "reaction"},inplace=True)
-        rules_df = pd.melt(rules_df,ignore_index=False,id_vars=["reaction"],value_vars=list(maps.keys()),var_name="origin")
-        rules_df.dropna(inplace=True)
-        rules_df = rules_df.explode("value")
-        rules_df.rename(columns={"value": "rule"},inplace=True)
-        rules_df.reset_index(drop=True,inplace=True)
-        rules_df.sort_values(by=["origin","reaction"],inplace=True)
-        rules_df.reset_index(drop=True,inplace=True)
-        # OUTPATH = "reaction_mapping/combined_rn_to_ko_rules-MOFILTERFIX.csv"
-        rules_df.to_csv(OUTPATH,index=False)
+        """
+        Spreadsheet of reaction, origin, rule rows (see kegg_rules.tables), sorted by origin then reaction.
+        Each rule is one KO set, its KOs sorted and joined with "+" (e.g. K00001+K00002).
+        """
+        write_rules_csv(OUTPATH, maps, key_col="reaction")
+
+    @staticmethod
+    def dump_maps_to_parquet(maps, OUTPATH = "final_map/rn2ko_map_by_type.parquet"):
+        """Same rows as dump_maps_to_csv, with each rule as a list of KOs. Needs pyarrow"""
+        write_rules_parquet(OUTPATH, maps, key_col="reaction")
+
+    @staticmethod
+    def diff_maps_to(maps, path = "final_map/v3/rn2ko_map_by_type.pkl"):
+        """
+        Added, removed and changed rules per map type between a stored version (pickle, rule file or
+        rule table) and `maps`, as a kegg_rules.diff report. Prints the counts per map type.
+        """
+        report = diff_maps(load_maps(path), maps)
+        print("Changes from %s:" % path)
+        print(summarize_diff(report).to_string() if len(report) else "  none")
+        return report
 
 
     ########################################################################################
     ## CORE PIPELINE FUNCTIONS TO GENERATE MAPS
     ########################################################################################
+    ## Stage graph of generate_all_maps: map name -> (method producing it, inputs it reads).
+    ## Inputs are either KEGG inputs (file-backed properties), derived state, or a CSV path argument of generate_all_maps
+    STAGE_INPUT_FILES = {"module_entry_dict": ["module_entries"],
+                         "reaction_entry_dict": ["reaction_entries"],
+                         "mo_to_ko_dict": ["mo_to_ko_dict"],
+                         "mo_to_rn_dict": ["mo_to_rn_dict"],
+                         "rn_to_ko_dict": ["rn_to_ko_dict"],
+                         "rn_to_mo_dict": ["rn_to_mo_dict"],
+                         "plusmodules": ["module_entries", "mo_to_rn_dict", "rn_to_ko_dict"]}
+    STAGES = {"map_rn2ko_viaMO_noaddition": ("map_rn2ko_viaMO_noaddition", ["plusmodules", "mo_to_rn_dict", "rn_to_ko_dict", "mo_to_ko_dict"]),
+              "map_rn2ko_viaMO_addition1minus": ("map_rn2ko_viaMO_addition1minus", ["plusmodules", "rn_to_ko_dict"]),
+              "map_rn2ko_viaMO_addition1minus_extras": ("map_rn2ko_viaMO_addition1minus_extras", ["module_entry_dict", "mo_to_rn_dict", "rn_to_mo_dict", "rn_to_ko_dict"]),
+              "map_rn2ko_viaMO_addition2plus": ("from_csv_rn2ko_viaMO_addition2plus", ["rn2ko_viaMO_addition2plus_path"]),
+              "map_rn2ko_viaKO_1minus": ("map_rn2ko_viaKO_1minus", ["rn_to_ko_dict", "rn_to_mo_dict"]),
+              "map_rn2ko_viaKO_2plus": ("from_csv_rn2ko_viaKO_2plus", ["rn2ko_viaKO_2plus_path"]),
+              "map_rn2ko_viaEC_1minus": ("from_csv_rn2ko_viaEC_1minus", ["rn2ko_viaEC_1minus_path"]),
+              "map_rn2ko_viaEC_2plus": ("from_csv_rn2ko_viaEC_2plus", ["rn2ko_viaEC_2plus"]),
+              "map_rn2ko_spontaneous": ("map_rn2ko_spontaneous", ["reaction_entry_dict"])}
+
+    def input_file_paths(self):
+        return {"module_entries": self.module_entries_path, "reaction_entries": self.reaction_entries_path, **self.link_paths}
+
+    def stage_files(self, stage, csv_paths):
+        """(input name, path) of every file a stage's output depends on"""
+        file_paths = self.input_file_paths()
+        files = set()
+        for name in self.STAGES[stage][1]:
+            if name in csv_paths:
+                files.add((name, csv_paths[name]))
+            else:
+                files.update((f, file_paths[f]) for f in self.STAGE_INPUT_FILES[name])
+        return sorted(files)
+
+    @staticmethod
+    def stage_code_paths():
+        """Source files whose code shapes stage outputs: this module and the kegg_rules modules the stages call into"""
+        modules = [sys.modules[__name__], spreadsheet, sys.modules[KeywordTagger.__module__], sys.modules[SymbolTable.__module__]]
+        return sorted({os.path.abspath(module.__file__) for module in modules})
+
+    def stage_cache_entry(self, stage, csv_paths):
+        """(path of the stage's cache entry, cached entry or None). The entry path is None without a cache"""
+        if self.cache is None:
+            return None, None
+        ## Content addressed: the key only depends on what the inputs and the code contain
+        key = "|".join([stage] + ["code=%s" % self.cache.digest(path) for path in self.stage_code_paths()] +
+                       ["%s=%s" % (name, self.cache.digest(path)) for name, path in self.stage_files(stage, csv_paths)])
+        entry_path = self.cache.entry_path("stage-"+stage, key)
+        return entry_path, self.cache.read_entry(entry_path)
+
+    def compute_stage(self, stage, csv_paths):
+        """Run a stage's method and return its map as built, before interning. Safe to call from worker threads"""
+        method, inputs = self.STAGES[stage]
+        getattr(self, method)(*[csv_paths[name] for name in inputs if name in csv_paths])
+        return self.maps[stage]
+
+    def store_stage(self, stage, value, entry_path=None):
+        """Intern a computed map into self.maps, caching it at `entry_path` if given. Not thread safe (see rule_pool)"""
+        self.maps[stage] = self.rule_pool.rules(value)
+        if entry_path is not None:
+            self.cache.write_entry(entry_path, {"value": self.maps[stage], "issues": self.spreadsheet_issues.get(stage)})
+        return self.maps[stage]
+
+    def restore_stage(self, stage, entry):
+        """Map of a cached stage entry; also restores the stage's spreadsheet issues"""
+        if entry.get("issues") is not None:
+            self.spreadsheet_issues[stage] = entry["issues"]
+        return self.rule_pool.rules(entry["value"])
+
+    def run_stage(self, stage, csv_paths):
+        """
+        Run one stage of generate_all_maps, or reuse its cached output if none of its input files
+        (nor the code in stage_code_paths) changed since it was cached. Returns True if the output was reused.
+        """
+        entry_path, entry = self.stage_cache_entry(stage, csv_paths)
+        if entry is not None:
+            self.maps[stage] = self.restore_stage(stage, entry)
+            return True
+        self.store_stage(stage, self.compute_stage(stage, csv_paths), entry_path)
+        return False
+
+    def _load_inputs(self, names):
+        ## Parse the named lazy inputs now, so threads using them later don't race to load them
+        for name in names:
+            getattr(self, name)
+
+    def load_stage_inputs(self, stages, csv_paths):
+        ## Parse the KEGG inputs of `stages` up front, so stages running in parallel don't race to load them
+        self._load_inputs({"plusmodule_state" if name == "plusmodules" else name
+                           for stage in stages for name in self.STAGES[stage][1] if name not in csv_paths})
+
     def generate_all_maps(self,
                           rn2ko_viaMO_addition2plus_path = "reaction_ko_keywords/KEGG.ReactionsToKOs.Ambiguous.12July2021+module_rns.csv",
                           rn2ko_viaKO_2plus_path = "reaction_ko_keywords/KEGG.ReactionsToKOs.Ambiguous.12July2021-NEWER2.csv",
                           rn2ko_viaEC_1minus_path = "reaction_ko_keywords/KEGG.ReactionsToKOs.Ambiguous.12July2021-resolved.rn2ko.viaEC.csv",
-                          rn2ko_viaEC_2plus = "reaction_ko_keywords/KEGG.ReactionsToKOs.Ambiguous.12July2021-ambig.rn2ko.viaEC.csv"):#,reaction_json_path, rsetinplusmodules2plus_to_csv_OUTPATH):
-        """Map from all sources, including manually mapped CSVs"""
-        self.map_rn2ko_viaMO_noaddition()
-        self.map_rn2ko_viaMO_addition1minus()
-        self.map_rn2ko_viaMO_addition1minus_extras()
-        self.from_csv_rn2ko_viaMO_addition2plus(rn2ko_viaMO_addition2plus_path)
-        self.map_rn2ko_viaKO_1minus()
-        self.from_csv_rn2ko_viaKO_2plus(rn2ko_viaKO_2plus_path)
-        self.from_csv_rn2ko_viaEC_1minus(rn2ko_viaEC_1minus_path)
-        self.from_csv_rn2ko_viaEC_2plus(rn2ko_viaEC_2plus)
-        self.map_rn2ko_spontaneous()
+                          rn2ko_viaEC_2plus = "reaction_ko_keywords/KEGG.ReactionsToKOs.Ambiguous.12July2021-ambig.rn2ko.viaEC.csv",
+                          jobs = 1):#,reaction_json_path, rsetinplusmodules2plus_to_csv_OUTPATH):
+        """
+        Map from all sources, including manually mapped CSVs.
+
+        Stages whose input files are unchanged since a previous run reuse their cached output (see run_stage);
+        which ones were reused or rerun is printed and kept in `self.stage_report`.
+
+        :param jobs: number of threads to run stages on; the maps are the same (and in the same order) for any value
+        """
+        csv_paths = {"rn2ko_viaMO_addition2plus_path": rn2ko_viaMO_addition2plus_path,
+                     "rn2ko_viaKO_2plus_path": rn2ko_viaKO_2plus_path,
+                     "rn2ko_viaEC_1minus_path": rn2ko_viaEC_1minus_path,
+                     "rn2ko_viaEC_2plus": rn2ko_viaEC_2plus}
+
+        self.stage_report = {"reused": [], "rerun": []}
+        if jobs == 1:
+            for stage in self.STAGES:
+                reused = self.run_stage(stage, csv_paths)
+                self.stage_report["reused" if reused else "rerun"].append(stage)
+        else:
+            ## Stages don't depend on each other, only on inputs: run the ones not cached on a thread pool,
+            ## then intern every map into self.maps in STAGES order, on this thread only
+            entries, pending = dict(), dict()
+            for stage in self.STAGES:
+                entry_path, entry = self.stage_cache_entry(stage, csv_paths)
+                if entry is not None:
+                    entries[stage] = entry
+                else:
+                    pending[stage] = entry_path
+            self.load_stage_inputs(pending, csv_paths)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = {stage: executor.submit(self.compute_stage, stage, csv_paths) for stage in pending}
+                outputs = {stage: future.result() for stage, future in futures.items()}
+            for stage in self.STAGES:
+                if stage in pending:
+                    self.store_stage(stage, outputs[stage], pending[stage])
+                else:
+                    self.maps[stage] = self.restore_stage(stage, entries[stage])
+                self.stage_report["rerun" if stage in pending else "reused"].append(stage)
 
         for k,v in self.maps.items():
             if v != None:
                 print(k, len(v))
+        print("Reused %d stages: %s" % (len(self.stage_report["reused"]), ", ".join(self.stage_report["reused"])))
+        print("Reran %d stages: %s" % (len(self.stage_report["rerun"]), ", ".join(self.stage_report["rerun"])))
+        print("%d KO sets interned as %d shared frozensets" % (self.rule_pool.requested, len(self.rule_pool)))
 
         return self.maps
 
@@ -621,12 +923,27 @@ class Mapping:
                                           rn2ko_viaMO_addition2plus_path = "csvs_need_mapping/rn2ko_viaMO_addition2plus.csv",
                                           rn2ko_viaKO_2plus_path = "csvs_need_mapping/rn2ko_viaKO_2plus.csv",
                                           rn2ko_viaEC_1minus_path = "csvs_need_mapping/rn2ko_viaEC_1minus.csv",
-                                          rn2ko_viaEC_2plus_path = "csvs_need_mapping/rn2ko_viaEC_2plus.csv"):
-        """Write all CSVs which will need manual mapping"""
-        self.to_csv_rn2ko_viaMO_addition2plus(rn2ko_viaMO_addition2plus_path)
-        self.to_csv_rn2ko_viaKO_2plus(rn2ko_viaKO_2plus_path)
-        self.to_csv_rn2ko_viaEC_1minus(rn2ko_viaEC_1minus_path)
-        self.to_csv_rn2ko_viaEC_2plus(rn2ko_viaEC_2plus_path)
+                                          rn2ko_viaEC_2plus_path = "csvs_need_mapping/rn2ko_viaEC_2plus.csv",
+                                          jobs = 1):
+        """
+        Write all CSVs which will need manual mapping
+
+        :param jobs: number of threads to write the CSVs on
+        """
+        writers = [(self.to_csv_rn2ko_viaMO_addition2plus, rn2ko_viaMO_addition2plus_path),
+                   (self.to_csv_rn2ko_viaKO_2plus, rn2ko_viaKO_2plus_path),
+                   (self.to_csv_rn2ko_viaEC_1minus, rn2ko_viaEC_1minus_path),
+                   (self.to_csv_rn2ko_viaEC_2plus, rn2ko_viaEC_2plus_path)]
+        if jobs == 1:
+            for write, OUTPATH in writers:
+                write(OUTPATH)
+            return
+
+        ## Load shared inputs first so the writers don't race to parse them
+        self._load_inputs(["module_entry_dict", "reaction_entry_dict", "rn_to_mo_dict", "rn_to_ko_dict", "plusmodule_state", "reaction_keywords"])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for future in [executor.submit(write, OUTPATH) for write, OUTPATH in writers]:
+                future.result() ## Raise any error
 
 if __name__ == "__main__":
 
@@ -638,3 +955,5 @@ if __name__ == "__main__":
     map.dump_maps_by_type(maps, OUTPATH="final_map/v3/rn2ko_map_by_type.pkl")
     map.dump_maps_combined(maps, OUTPATH="final_map/v3/rn2ko_map_combined.pkl")
     map.dump_maps_to_csv(maps, OUTPATH="final_map/v3/rn2ko_map_by_type.csv")
+    map.dump_maps_to_rulefile(maps, OUTPATH="final_map/v3/rn2ko_map_by_type.rules")
+    map.dump_maps_to_rulefile(maps, OUTPATH="final_map/v3/rn2ko_map_combined.rules", combined=True)
@@ -0,0 +1,180 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import sys
+from unittest import mock
+sys.path.append("..")
+from mapping import Mapping, InputCache
+
+class MappingInputs:
+    ## Small set of KEGG inputs and manually mapped sheets, written to a temporary directory
+    modules = {"M00001": {"definition": "K00001 K00002", "orthologs": {"K00001": "a", "K00002": "b"}},
+               "M00002": {"definition": "K00003+K00004", "orthologs": {"K00003+K00004": "c"}}}
+    reactions = {"R00001": {"comment": "", "orthologs": {"K00001": "a"}},
+                 "R00004": {"comment": "Spontaneous reaction", "orthologs": {"K00005": "e subunit"}},
+                 "R00005": {"comment": "", "orthologs": {"K00006": "f", "K00007": "g"}}}
+    links = {"mo_to_ko_dict": {"M00001": ["K00001", "K00002"], "M00002": ["K00003", "K00004"]},
+             "mo_to_rn_dict": {"M00001": ["R00001"], "M00002": ["R00002", "R00003"]},
+             "rn_to_ko_dict": {"R00001": ["K00001"], "R00002": ["K00003", "K00004"], "R00003": ["K00003"],
+                               "R00004": ["K00005"], "R00005": ["K00006", "K00007"]},
+             "rn_to_mo_dict": {"R00001": ["M00001"], "R00002": ["M00002"], "R00003": ["M00002"]}}
+    sheets = {"rn2ko_viaMO_addition2plus_path": "Reaction,Rule\nR00002,K00003+K00004\n",
+              "rn2ko_viaKO_2plus_path": 'Reaction,Rule\nR00005,"K00006,K00007"\n',
+              "rn2ko_viaEC_1minus_path": "rn,ko_list\nR00010,K00010\n",
+              "rn2ko_viaEC_2plus": 'rn,rule,ko_list\nR00011,K00011+K00012,"K00011,K00012"\n'}
+
+    def __init__(self, root):
+        self.root = root
+        self.links_path = os.path.join(root, "links")
+        os.makedirs(self.links_path)
+        self.module_entries_path = self.write_json("module_entries.json", self.modules)
+        self.reaction_entries_path = self.write_json("reaction_entries.json", self.reactions)
+        for name, links in self.links.items():
+            self.write_json(os.path.join("links", name+".json"), links)
+        self.csv_paths = {name: self.write(name+".csv", text) for name, text in self.sheets.items()}
+
+    def write(self, name, text):
+        path = os.path.join(self.root, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def write_json(self, name, obj):
+        return self.write(name, json.dumps(obj))
+
+    def mapping(self, cache_dir):
+        return Mapping(self.module_entries_path, self.reaction_entries_path, self.links_path, cache_dir=cache_dir)
+
+class TestInputCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "input.json")
+        with open(self.path, "w") as f:
+            json.dump({"a": 1}, f)
+        self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+        self.parsed = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def parse(self, path):
+        self.parsed.append(path)
+        return Mapping.load_json_into_dict(path)
+
+    def test_reuse_touch_and_edit(self):
+        self.assertEqual(InputCache(self.cache_dir).load(self.path, self.parse, "input"), {"a": 1})
+
+        cache = InputCache(self.cache_dir)
+        self.assertEqual(cache.load(self.path, self.parse, "input"), {"a": 1})
+        os.utime(self.path, ns=(0, 0)) ## Touched: rehashed, same content
+        self.assertEqual(cache.load(self.path, self.parse, "input"), {"a": 1})
+        self.assertEqual((cache.reused, cache.rebuilt), (["input", "input"], []))
+
+        with open(self.path, "w") as f:
+            json.dump({"a": 2}, f)
+        cache = InputCache(self.cache_dir)
+        self.assertEqual(cache.load(self.path, self.parse, "input"), {"a": 2})
+        self.assertEqual((cache.reused, cache.rebuilt), ([], ["input"]))
+        self.assertEqual(len(self.parsed), 2)
+
+    def test_derive_is_keyed_by_content(self):
+        compute = mock.Mock(return_value="derived")
+        for _ in range(2):
+            cache = InputCache(self.cache_dir)
+            self.assertEqual(cache.derive("state", [self.path], compute), "derived")
+        self.assertEqual(compute.call_count, 1)
+        self.assertEqual(cache.reused, ["state"])
+
+class TestLazyInputs(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.inputs = MappingInputs(self.tmpdir.name)
+        self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_inputs_are_loaded_on_first_use(self):
+        mapping = self.inputs.mapping(self.cache_dir)
+        self.assertEqual(mapping.cache.rebuilt, [])
+        mapping.from_csv_rn2ko_viaKO_2plus(self.inputs.csv_paths["rn2ko_viaKO_2plus_path"])
+        self.assertEqual(mapping.cache.rebuilt, [])
+        mapping.map_rn2ko_viaKO_1minus()
+        self.assertEqual(sorted(mapping.cache.rebuilt), ["rn_to_ko_dict", "rn_to_mo_dict"])
+        self.assertNotIn("reaction_entry_dict", vars(mapping))
+
+    def test_cached_inputs_match_uncached(self):
+        self.inputs.mapping(self.cache_dir).plusmodule_state
+        cached = self.inputs.mapping(self.cache_dir)
+        uncached = self.inputs.mapping(None)
+        self.assertEqual(cached.plusmodule_state, uncached.plusmodule_state)
+        self.assertEqual(cached.mo_to_rn_dict, uncached.mo_to_rn_dict)
+        self.assertIn("plusmodules", cached.cache.reused)
+
+class TestStageCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.inputs = MappingInputs(self.tmpdir.name)
+        self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+        self.first = self.generate()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def generate(self, jobs=1):
+        self.mapping = self.inputs.mapping(self.cache_dir)
+        return dict(self.mapping.generate_all_maps(**self.inputs.csv_paths, jobs=jobs))
+
+    def test_first_run_builds_every_stage(self):
+        self.assertEqual(self.mapping.stage_report, {"reused": [], "rerun": list(Mapping.STAGES)})
+        self.assertEqual(self.first["map_rn2ko_viaMO_addition2plus"], {"R00002": {frozenset(["K00003", "K00004"])}})
+        self.assertEqual(self.first["map_rn2ko_viaEC_2plus"], {"R00011": {frozenset(["K00011", "K00012"])}})
+        self.assertEqual(self.first["map_rn2ko_spontaneous"], {"R00004": {frozenset(["spontaneous"])}})
+
+    def test_unchanged_inputs_reuse_every_stage(self):
+        self.assertEqual(self.generate(), self.first)
+        self.assertEqual(self.mapping.stage_report, {"reused": list(Mapping.STAGES), "rerun": []})
+        self.assertEqual(self.mapping.cache.rebuilt, [])
+
+    def test_touch_reuses_and_edit_reruns_only_its_stage(self):
+        path = self.inputs.csv_paths["rn2ko_viaKO_2plus_path"]
+        os.utime(path, ns=(0, 0))
+        self.generate()
+        self.assertEqual(self.mapping.stage_report["rerun"], [])
+
+        with open(path, "a") as f:
+            f.write("R00006,K00008+K00009\n")
+        maps = self.generate(jobs=2)
+        self.assertEqual(self.mapping.stage_report["rerun"], ["map_rn2ko_viaKO_2plus"])
+        self.assertEqual(maps["map_rn2ko_viaKO_2plus"]["R00006"], {frozenset(["K00008", "K00009"])})
+
+    def test_jobs_match_serial(self):
+        requested, interned = self.mapping.rule_pool.requested, len(self.mapping.rule_pool)
+        shutil.rmtree(self.cache_dir)
+        maps = self.generate(jobs=4)
+        self.assertEqual(maps, self.first)
+        self.assertEqual(list(maps), list(self.first))
+        self.assertEqual((self.mapping.rule_pool.requested, len(self.mapping.rule_pool)), (requested, interned))
+
+    def test_link_edit_reruns_dependent_stages(self):
+        links = dict(self.inputs.links["rn_to_mo_dict"], R00004=["M00001"])
+        self.inputs.write_json(os.path.join("links", "rn_to_mo_dict.json"), links)
+        self.generate()
+        self.assertEqual(self.mapping.stage_report["rerun"], ["map_rn2ko_viaMO_addition1minus_extras", "map_rn2ko_viaKO_1minus"])
+        self.assertEqual(self.mapping.cache.rebuilt, ["rn_to_mo_dict"])
+
+    def test_code_edit_reruns_every_stage(self):
+        code_paths = [os.path.basename(path) for path in Mapping.stage_code_paths()]
+        self.assertEqual(sorted(code_paths), ["keywords.py", "mapping.py", "spreadsheet.py", "symbols.py"])
+
+        code = self.inputs.write("code.py", "VERSION = 1\n")
+        with mock.patch.object(Mapping, "stage_code_paths", return_value=[code]):
+            self.generate()
+            self.inputs.write("code.py", "VERSION = 2\n")
+            self.generate()
+        self.assertEqual(self.mapping.stage_report, {"reused": [], "rerun": list(Mapping.STAGES)})
+
+if __name__ == '__main__':
+    unittest.main()
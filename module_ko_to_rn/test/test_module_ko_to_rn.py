@@ -1,7 +1,14 @@
 import os
 import json
+import re
+import pickle
+import copy
 import unittest
 import sys
+import io
+import time
+import tempfile
+from unittest import mock
 sys.path.append("..")
 from module_ko_to_rn import *
 
@@ -19,7 +26,7 @@ class TestParseOrthologs(unittest.TestCase):
                 self.module_entry_dict = json.load(f)
         else:
             self.module_name_dict = create_id_name_dict(self.db)
-            self.module_entry_dict = retrieve_entry_info(self.module_name_dict,self.db)
+            self.module_entry_dict = retrieve_entry_info(self.module_name_dict,self.db,checkpoint_path=self.entry_dict_path+".checkpoint")
             with open(self.entry_dict_path, 'w') as f:
                 json.dump(self.module_entry_dict, f, indent=4)
 
@@ -146,3 +153,429 @@ class TestParseOrthologs(unittest.TestCase):
         #     data = combineValidExprs(data) ## Transforms all but the top level to ValidExprs objs
         #     data = combineValidExprs(data) ## Transforms top level (Returns a single ValidExprs obj)
         #     calculated_module_dict[mid] = {frozenset(i) for i in data.expressions} - {frozenset()}
+
+
+class TestRetrieveEntryInfo(unittest.TestCase):
+    def setUp(self):
+        self.id_name_dict = {"md:M00001": "Glycolysis", "md:M00002": "Glycolysis, core module", "md:M00003": "Gluconeogenesis"}
+        self.calls = []
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.checkpoint_path = os.path.join(self.tmpdir.name, "entries.checkpoint")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fake_entry(self, db, entry_id, format=None):
+        self.calls.append(entry_id)
+        ## M00002 fails on its first attempt only
+        if entry_id == "M00002" and self.calls.count(entry_id) == 1:
+            raise IOError("temporary failure")
+        return io.StringIO(json.dumps([{"entry_id": entry_id, "definition": "K00001"}]))
+
+    def test_retries_and_ordering(self):
+        with mock.patch.object(TogoWS, "entry", self.fake_entry):
+            id_entry_dict = retrieve_entry_info(self.id_name_dict, "module", jobs=3, rate=None, backoff=0)
+        self.assertEqual(list(id_entry_dict), ["M00001", "M00002", "M00003"])
+        self.assertEqual(self.calls.count("M00002"), 2)
+
+    def test_resume_from_checkpoint(self):
+        with open(self.checkpoint_path, "w") as f:
+            f.write(json.dumps({"id": "M00001", "entry": {"entry_id": "M00001", "definition": "K00001"}}) + "\n")
+            f.write('{"id": "M00003", "ent') ## Interrupted mid-write
+
+        with mock.patch.object(TogoWS, "entry", self.fake_entry):
+            id_entry_dict = retrieve_entry_info(self.id_name_dict, "module", rate=None, backoff=0, checkpoint_path=self.checkpoint_path)
+        self.assertEqual(sorted(set(self.calls)), ["M00002", "M00003"])
+        self.assertEqual(list(id_entry_dict), ["M00001", "M00002", "M00003"])
+        self.assertEqual(load_checkpoint(self.checkpoint_path), id_entry_dict)
+
+    def test_failures_are_reported_not_checkpointed(self):
+        def always_fails(db, entry_id, format=None):
+            raise IOError("down")
+        with mock.patch.object(TogoWS, "entry", always_fails):
+            id_entry_dict = retrieve_entry_info(self.id_name_dict, "module", rate=None, retries=1, backoff=0, checkpoint_path=self.checkpoint_path)
+        self.assertEqual(id_entry_dict, {})
+        self.assertEqual(load_checkpoint(self.checkpoint_path), {})
+
+    def test_interrupt_cancels_queued_and_checkpoints_finished(self):
+        id_name_dict = {"md:M%05d" % i: "Module %d" % i for i in range(40)}
+        def slow_entry(db, entry_id, format=None):
+            self.calls.append(entry_id)
+            time.sleep(0.01)
+            return io.StringIO(json.dumps([{"entry_id": entry_id}]))
+        def interrupted_tqdm(iterable, total=None):
+            ## Ctrl-C after three entries were taken, while more have finished but weren't taken yet
+            for i, item in enumerate(iterable):
+                if i == 3:
+                    time.sleep(0.1)
+                    raise KeyboardInterrupt
+                yield item
+
+        with mock.patch.object(TogoWS, "entry", slow_entry), \
+             mock.patch.object(sys.modules["module_ko_to_rn"], "tqdm", interrupted_tqdm):
+            with self.assertRaises(KeyboardInterrupt):
+                retrieve_entry_info(id_name_dict, "module", jobs=2, rate=None, checkpoint_path=self.checkpoint_path)
+        checkpointed = load_checkpoint(self.checkpoint_path)
+        time.sleep(0.05) ## Let the requests that were running finish
+        self.assertLess(len(self.calls), len(id_name_dict))
+        self.assertGreater(len(checkpointed), 3)
+        self.assertLessEqual(set(checkpointed), set(self.calls))
+
+
+class TestRefreshKEGGFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.entry_dict_path = os.path.join(self.tmpdir.name, "module_entry_dict-2021_03_22.json")
+        self.link_path = os.path.join(self.tmpdir.name, "ko_rn_link_dicts-2021_03_10.json")
+        old_entries = {
+            "M00001": {"name": "Glycolysis", "definition": "K00001"},
+            "M00002": {"name": "Old name", "definition": "K00002"},
+            "M00003": {"name": "Removed", "definition": "K00003"},
+            "M00005": {"name": "Relinked", "definition": "K00005"},
+        }
+        with open(self.entry_dict_path, "w") as f:
+            json.dump(old_entries, f)
+        with open(self.link_path, "w") as f:
+            json.dump([{"R02289": ["K15023"], "R00001": ["K00001"]}, {}], f)
+        self.fetched = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fake_entry(self, db, entry_id, format=None):
+        self.fetched.append(entry_id)
+        names = {"M00002": "New name", "M00004": "Added", "M00005": "Relinked"}
+        return io.StringIO(json.dumps([{"name": names[entry_id], "definition": "K00002+K00004"}]))
+
+    def test_only_new_and_renamed_entries_are_fetched(self):
+        listing = "md:M00001\tGlycolysis\nmd:M00002\tNew name\nmd:M00004\tAdded\nmd:M00005\tRelinked\n"
+        links = {"reaction": "rn:R02289\tko:K15023\nrn:R02289\tko:K25221\nrn:R00001\tko:K00001\n",
+                 "module": "md:M00001\tko:K00001\nmd:M00002\tko:K00002\nmd:M00004\tko:K00002\nmd:M00005\tko:K00006\n"}
+        with mock.patch.object(REST, "kegg_list", lambda db: io.StringIO(listing)), \
+             mock.patch.object(REST, "kegg_link", lambda a, b: io.StringIO(links[b])), \
+             mock.patch.object(TogoWS, "entry", self.fake_entry):
+            module_entry_dict, rn_ko_dict, ko_rn_dict, manifest = refresh_KEGG_files(
+                "module", self.entry_dict_path, self.link_path, date="2022_01_01", rate=None)
+
+        self.assertEqual(sorted(self.fetched), ["M00002", "M00004", "M00005"])
+        self.assertEqual(list(module_entry_dict), ["M00001", "M00002", "M00004", "M00005"])
+        self.assertEqual(manifest["added"], ["M00004"])
+        self.assertEqual(manifest["removed"], ["M00003"])
+        self.assertEqual(manifest["changed"], {"M00002": ["definition", "name"], "M00005": ["definition"]})
+        self.assertEqual(manifest["unverified"], ["M00001"])
+        self.assertEqual(manifest["rn_ko_links"]["changed"], {"R02289": {"added": ["K25221"], "removed": []}})
+
+        with open(os.path.join(self.tmpdir.name, "module_entry_dict-2022_01_01.json")) as f:
+            self.assertEqual(json.load(f), module_entry_dict)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir.name, "module_entry_manifest-2022_01_01.json")))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir.name, "ko_rn_link_dicts-2022_01_01.json")))
+
+
+def exprStructure(data):
+    ## Comparable form of a parsed definition
+    if isinstance(data, str):
+        return data
+    return (type(data).__name__, data.op, tuple(exprStructure(term) for term in data.terms))
+
+class TestDefinitionParser(unittest.TestCase):
+    def setUp(self):
+        with open("assets/module_entry_dict-2021_03_22.json", 'r') as f:
+            self.module_entry_dict = json.load(f)
+        self.definitions = {mid: d["definition"] for mid, d in self.module_entry_dict.items() if not re.findall(r'[M]\d{5}', d["definition"])}
+
+    def test_edge_cases_match_pyparsing(self):
+        defs = ["(K00001)",
+                "K00001+K00002-K00003-K00004,K00005 K00006",
+                "((K00001,K00002) K00003),K00004+(K00005 -K00006)",
+                "K00001 -K00002",
+                "K00001-(K00002,K00003)",
+                "'K00001'+K00002"]
+        for module_def in defs:
+            self.assertEqual(exprStructure(getTopLevelOp(module_def)), exprStructure(getTopLevelOpPyparsing(module_def)), module_def)
+
+    def test_lenient_cases_match_pyparsing_when_accepted(self):
+        ## pyparsing 2.x accepts these, 3.x raises ParseException; compare only where it parses
+        defs = ["K00001 K00002 --",
+                "K00001 - K00002",
+                "K00001 +K00002"]
+        for module_def in defs:
+            try:
+                expected = getTopLevelOpPyparsing(module_def)
+            except pp.ParseException:
+                continue
+            self.assertEqual(exprStructure(getTopLevelOp(module_def)), exprStructure(expected), module_def)
+
+    def test_whitespace_runs_are_one_then(self):
+        ## Documented difference from the White(exact=1) grammar, which rejects these
+        self.assertEqual(exprStructure(getTopLevelOp("K00001  K00002")), exprStructure(getTopLevelOp("K00001 K00002")))
+        self.assertEqual(exprStructure(getTopLevelOp("K00001 K00002  K00003")), exprStructure(getTopLevelOp("K00001 K00002 K00003")))
+
+    def test_full_snapshot_matches_pyparsing_output(self):
+        ## assets/calculated_module_dict.pkl was produced by the pyparsing path
+        with open("assets/calculated_module_dict.pkl", 'rb') as f:
+            expected = pickle.load(f)
+        for mid, module_def in self.definitions.items():
+            data = getTopLevelOp(module_def)
+            data = replaceStrsWithValidExprs(data)
+            data = combineValidExprs(data)
+            data = combineValidExprs(data)
+            self.assertEqual({frozenset(i) for i in data.expressions} - {frozenset()}, expected[mid], mid)
+
+    def test_full_snapshot_matches_pyparsing_trees(self):
+        ## pyparsing 3 rejects definitions with "--" (2.x accepts them); compare every definition it parses
+        rejected = set()
+        for mid, module_def in self.definitions.items():
+            try:
+                expected = getTopLevelOpPyparsing(module_def)
+            except pp.ParseException:
+                rejected.add(mid)
+                continue
+            self.assertEqual(exprStructure(getTopLevelOp(module_def)), exprStructure(expected), mid)
+        if rejected:
+            self.assertEqual(rejected, {mid for mid, module_def in self.definitions.items() if "--" in module_def})
+
+
+class TestStreamingExpansion(unittest.TestCase):
+    def setUp(self):
+        with open("assets/module_entry_dict-2021_03_22.json", 'r') as f:
+            self.module_entry_dict = json.load(f)
+        with open("assets/calculated_module_dict.pkl", 'rb') as f:
+            self.calculated_module_dict = pickle.load(f)
+
+    def test_matches_list_expansion(self):
+        for mid, expected in self.calculated_module_dict.items():
+            data = getTopLevelOp(self.module_entry_dict[mid]["definition"])
+            streamed = list(iterModuleKOSets(data))
+            self.assertEqual(len(streamed), len(set(streamed)), mid) ## No duplicates
+            self.assertEqual(set(streamed), expected, mid)
+
+    def test_limit(self):
+        data = getTopLevelOp(self.module_entry_dict["M00009"]["definition"])
+        first = list(iterModuleKOSets(data, limit=5))
+        self.assertEqual(len(first), 5)
+        self.assertTrue(set(first) <= self.calculated_module_dict["M00009"])
+
+    def test_is_lazy(self):
+        ## 30 optional terms -> 2**30 combinations, only the first few are ever built
+        data = getTopLevelOp("K00001" + "".join("-K%05d" % i for i in range(2, 32)))
+        first = list(iterModuleKOSets(data, limit=3))
+        self.assertEqual(len(first), 3)
+        self.assertEqual(first[0], frozenset("K%05d" % i for i in range(1, 32)))
+
+    def test_bitmasks(self):
+        symbols = SymbolTable()
+        for mid, expected in self.calculated_module_dict.items():
+            definition = self.module_entry_dict[mid]["definition"]
+            self.assertEqual(parse_module_definition(definition, symbols=symbols), expected, mid)
+        data = getTopLevelOp(self.module_entry_dict["M00009"]["definition"])
+        masks = list(iterModuleKOSets(data, symbols=symbols))
+        self.assertTrue(all(isinstance(m, int) for m in masks))
+        self.assertEqual({symbols.unmask(m) for m in masks}, self.calculated_module_dict["M00009"])
+
+    def test_bitmasks_reject_minimal_and_memoize(self):
+        for options in [dict(minimal=True), dict(memoize=True)]:
+            with self.assertRaises(ValueError):
+                parse_and_format_modules(self.module_entry_dict, bitmasks=True, **options)
+        with self.assertRaises(ValueError):
+            parse_module_definition("K00001+K00002", minimal=True, symbols=SymbolTable())
+
+
+class TestZDD(unittest.TestCase):
+    def setUp(self):
+        with open("assets/module_entry_dict-2021_03_22.json", 'r') as f:
+            self.module_entry_dict = json.load(f)
+        with open("assets/calculated_module_dict.pkl", 'rb') as f:
+            self.calculated_module_dict = pickle.load(f)
+        self.zdd, self.module_zdds = compile_module_zdds(self.module_entry_dict)
+
+    def test_round_trip(self):
+        self.assertEqual(zdd_to_calculated_module_dict(self.zdd, self.module_zdds), self.calculated_module_dict)
+        for mid, sets in self.calculated_module_dict.items():
+            self.assertEqual(self.zdd.count(self.module_zdds[mid]), len(sets), mid)
+
+    def test_queries(self):
+        sets = self.calculated_module_dict["M00009"]
+        n = self.module_zdds["M00009"]
+        for fs in sets:
+            self.assertTrue(self.zdd.contains(n, fs))
+        self.assertFalse(self.zdd.contains(n, {"K00174"}))
+        self.assertFalse(self.zdd.contains(n, set()))
+
+        genome = {"K00174", "K00175", "K00177", "K01676", "K00239", "K00240"}
+        self.assertEqual(self.zdd.to_sets(self.zdd.subsets_of(n, genome)), {fs for fs in sets if fs <= genome})
+        self.assertEqual(self.zdd.to_sets(self.zdd.supersets_of(n, {"K00174", "K00175"})), {fs for fs in sets if fs >= {"K00174", "K00175"}})
+
+    def test_counts_without_enumerating(self):
+        ## 60 optional terms -> 2**60 sets
+        data = getTopLevelOp("K00001" + "".join("-K%05d" % i for i in range(2, 62)))
+        n = compileZDD(data, self.zdd)
+        self.assertEqual(self.zdd.count(n), 2**60)
+        self.assertTrue(self.zdd.contains(n, {"K00001", "K00030", "K00061"}))
+
+
+class TestMinimalSets(unittest.TestCase):
+    def setUp(self):
+        with open("assets/module_entry_dict-2021_03_22.json", 'r') as f:
+            self.module_entry_dict = json.load(f)
+        with open("assets/calculated_module_dict.pkl", 'rb') as f:
+            self.calculated_module_dict = pickle.load(f)
+
+    def test_prune_supersets(self):
+        pruned = pruneSupersets([["K1", "K2"], ["K1"], [], ["K3"], ["K1"], ["K3", "K4"], ["K2", "K5"]])
+        self.assertEqual(pruned, [["K1"], [], ["K3"], ["K2", "K5"]])
+
+    def test_matches_minimal_sets_of_full_expansion(self):
+        for mid, sets in self.calculated_module_dict.items():
+            data = replaceStrsWithValidExprs(getTopLevelOp(self.module_entry_dict[mid]["definition"]))
+            data = combineValidExprs(combineValidExprs(data, minimal=True), minimal=True)
+            minimal = {frozenset(i) for i in data.expressions} - {frozenset()}
+            self.assertEqual(minimal, {fs for fs in sets if not any(other < fs for other in sets)}, mid)
+
+    def test_optional_steps_are_not_absorbed(self):
+        ## The empty set from "-K00002" mustn't prune the other steps
+        data = replaceStrsWithValidExprs(getTopLevelOp("K00001 -K00002 (K00003+K00004)"))
+        data = combineValidExprs(combineValidExprs(data, minimal=True), minimal=True)
+        self.assertEqual({frozenset(i) for i in data.expressions} - {frozenset()},
+                         {frozenset(["K00001"]), frozenset(["K00002"]), frozenset(["K00003", "K00004"])})
+
+
+class TestParallelBuild(unittest.TestCase):
+    def setUp(self):
+        with open("assets/module_entry_dict-2021_03_22.json", 'r') as f:
+            self.module_entry_dict = json.load(f)
+        ## The build functions write their pickles to ./assets
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmpdir.name, "assets"))
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def test_jobs_match_serial_in_order(self):
+        serial = parse_and_format_modules(self.module_entry_dict)
+        parallel = parse_and_format_modules(self.module_entry_dict, jobs=2)
+        self.assertEqual(list(parallel), list(serial))
+        self.assertEqual(parallel, serial)
+
+        serial_rules = create_dict_of_local_r_to_k_rules(serial, self.module_entry_dict)
+        parallel_rules = create_dict_of_local_r_to_k_rules(serial, self.module_entry_dict, jobs=2)
+        self.assertEqual(list(parallel_rules), list(serial_rules))
+        self.assertEqual(parallel_rules, serial_rules)
+
+    def test_shared_rule_sets(self):
+        pool = RuleSetPool()
+        calculated = parse_and_format_modules(self.module_entry_dict, pool=pool)
+        local_rules = create_dict_of_local_r_to_k_rules(calculated, self.module_entry_dict, jobs=2, pool=pool)
+        ## Equal KO sets are one object, across modules and across the two dicts
+        shared = {fs: fs for ruleset in calculated.values() for fs in ruleset}
+        for rules in local_rules.values():
+            for ruleset in rules.values():
+                for fs in ruleset:
+                    self.assertIs(fs, shared.setdefault(fs, fs))
+        self.assertLess(len(pool), pool.requested)
+
+        ## Building the global rules mustn't change the local ones
+        before = {mid: {rid: set(ruleset) for rid, ruleset in rules.items()} for mid, rules in local_rules.items()}
+        global_rules = create_dict_of_global_r_to_k_rules(local_rules)
+        self.assertEqual(local_rules, before)
+        union = dict()
+        for rules in before.values():
+            for rid, ruleset in rules.items():
+                union.setdefault(rid, set()).update(ruleset)
+        self.assertEqual(global_rules, union)
+
+    def test_pool_savings_are_measured(self):
+        with mock.patch("sys.stdout", io.StringIO()):
+            savings = report_pool_savings(self.module_entry_dict)
+        requested, interned = savings["sets"]
+        self.assertLess(interned, requested)
+        plain_retained, pooled_retained = savings["retained"]
+        self.assertGreater(pooled_retained, 0)
+        self.assertLess(pooled_retained, plain_retained)
+        self.assertGreaterEqual(savings["peak"][1], pooled_retained)
+
+    def test_global_rules_leave_local_rules_unchanged(self):
+        calculated = parse_and_format_modules(self.module_entry_dict)
+        local_rules = create_dict_of_local_r_to_k_rules(calculated, self.module_entry_dict)
+        before = copy.deepcopy(local_rules)
+        global_rules = create_dict_of_global_r_to_k_rules(local_rules)
+        self.assertEqual(local_rules, before)
+        self.assertEqual(global_rules["R04543"], before["M00083"]["R04543"])
+
+    def test_shipped_global_rules_are_unions_of_local_rules(self):
+        ## The assets were regenerated after the in-place merge had inflated them (R04543: 14 KO sets instead of 5)
+        with open(os.path.join(self.cwd, "assets/dict_of_local_r_to_k_rules.pkl"), 'rb') as f:
+            local_rules = pickle.load(f)
+        with open(os.path.join(self.cwd, "assets/dict_of_global_r_to_k_rules.pkl"), 'rb') as f:
+            global_rules = pickle.load(f)
+        self.assertEqual(len(local_rules["M00083"]["R04543"]), 5)
+        self.assertEqual(len(global_rules["R04543"]), 5)
+        union = dict()
+        for rules in local_rules.values():
+            for rid, ruleset in rules.items():
+                union.setdefault(rid, set()).update(ruleset)
+        self.assertEqual(global_rules, union)
+
+
+class TestExprMemo(unittest.TestCase):
+    def setUp(self):
+        with open("assets/module_entry_dict-2021_03_22.json", 'r') as f:
+            self.module_entry_dict = json.load(f)
+        with open("assets/calculated_module_dict.pkl", 'rb') as f:
+            self.calculated_module_dict = pickle.load(f)
+
+    def test_matches_expansion_with_shared_memo(self):
+        memo = ExprMemo()
+        for mid, sets in self.calculated_module_dict.items():
+            self.assertEqual(parse_module_definition(self.module_entry_dict[mid]["definition"], memo=memo), sets, mid)
+        self.assertGreater(memo.hits, 0)
+
+    def test_identical_blocks_are_expanded_once(self):
+        memo = ExprMemo()
+        parse_module_definition("(K00134,K00150) K00927", memo=memo)
+        misses = memo.misses
+        sets = parse_module_definition("K00001 (K00150,K00134)", memo=memo)
+        self.assertEqual(sets, {frozenset(["K00001"]), frozenset(["K00134"]), frozenset(["K00150"])})
+        self.assertEqual(memo.hits, 1)
+        self.assertEqual(memo.misses, misses + 1) ## Only the new top level
+        self.assertAlmostEqual(memo.hit_rate, 0.25)
+
+    def test_optional_or_order_matters(self):
+        ## The first term of a binary "-" is mandatory, so K1-K2 and K2-K1 differ
+        memo = ExprMemo()
+        self.assertEqual(parse_module_definition("K00001-K00002", memo=memo), {frozenset(["K00001"]), frozenset(["K00001", "K00002"])})
+        self.assertEqual(parse_module_definition("K00002-K00001", memo=memo), {frozenset(["K00002"]), frozenset(["K00001", "K00002"])})
+
+
+class TestKOSetIndex(unittest.TestCase):
+    def setUp(self):
+        with open("assets/module_entry_dict-2021_03_22.json", 'r') as f:
+            self.module_entry_dict = json.load(f)
+        with open("assets/calculated_module_dict.pkl", 'rb') as f:
+            self.calculated_module_dict = pickle.load(f)
+        with open("assets/dict_of_global_r_to_k_rules.pkl", 'rb') as f:
+            self.global_rules = pickle.load(f)
+
+    def test_subsets_of(self):
+        index = KOSetIndex([frozenset(["K1", "K2"]), frozenset(["K2"]), frozenset(["K3", "K4"]), frozenset()])
+        self.assertEqual(index.subsets_of(["K1", "K2", "K3"]), {frozenset(["K1", "K2"]), frozenset(["K2"]), frozenset()})
+        self.assertEqual(index.subsets_of([]), {frozenset()})
+
+    def test_matches_scan_in_get_r_to_k_rules(self):
+        for mid, sets in self.calculated_module_dict.items():
+            index = KOSetIndex(sets)
+            for k, v in self.module_entry_dict[mid]["orthologs"].items():
+                kids = set(re.findall(r'[K]\d{5}', k))
+                self.assertEqual(index.subsets_of(kids), {fs for fs in sets if fs.issubset(kids)}, mid)
+
+    def test_global_rules(self):
+        index = KOSetIndex.from_rules(self.global_rules)
+        genome = {"K00174", "K00175", "K01902", "K01903", "K00031", "K00382", "K01616"}
+        expected = dict()
+        for rid, ruleset in self.global_rules.items():
+            contained = {fs for fs in ruleset if fs <= genome}
+            if contained:
+                expected[rid] = contained
+        self.assertEqual(index.rules_satisfied_by(genome), expected)
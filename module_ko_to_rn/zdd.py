@@ -0,0 +1,197 @@
+##########################################
+## Zero-suppressed decision diagrams (ZDDs) for families of KO sets
+##########################################
+## A node stands for a family of sets. Node 0 is the empty family and node 1 is the family holding only
+## the empty set. Every other node is (var, lo, hi): the sets without `var` (lo) plus the sets with `var`
+## (hi, with `var` taken out). Variables are KO ids, ordered as strings with the smallest nearest the root,
+## and a node whose hi is 0 is never built, so families sharing structure share nodes.
+## All families built by one ZDD object share its node table and operation caches.
+
+class ZDD(object):
+    EMPTY = 0 ## {}
+    BASE = 1 ## {frozenset()}
+
+    def __init__(self):
+        self.nodes = [None, None] ## node -> (var, lo, hi)
+        self.unique = dict() ## (var, lo, hi) -> node
+        self.cache = dict() ## (operation, *args) -> node
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node(self, var, lo, hi):
+        if hi == self.EMPTY:
+            return lo
+        key = (var, lo, hi)
+        n = self.unique.get(key)
+        if n is None:
+            n = len(self.nodes)
+            self.nodes.append(key)
+            self.unique[key] = n
+        return n
+
+    def var(self, n):
+        ## Terminals sort after every KO
+        return self.nodes[n][0] if n > 1 else None
+
+    def before(self, a, b):
+        ## True if a's top variable comes before b's
+        va, vb = self.var(a), self.var(b)
+        return va is not None and (vb is None or va < vb)
+
+    ##########################################
+    ## Building families
+    ##########################################
+    def single(self, kos):
+        ## Family holding just the set `kos`
+        n = self.BASE
+        for ko in sorted(set(kos), reverse=True):
+            n = self.node(ko, self.EMPTY, n)
+        return n
+
+    def from_sets(self, sets):
+        n = self.EMPTY
+        for kos in sets:
+            n = self.union(n, self.single(kos))
+        return n
+
+    def union(self, a, b):
+        ## Sets in either family
+        if a == self.EMPTY or a == b:
+            return b
+        if b == self.EMPTY:
+            return a
+        if a > b:
+            a, b = b, a
+        key = ("union", a, b)
+        if key in self.cache:
+            return self.cache[key]
+
+        if self.before(a, b):
+            var, lo, hi = self.nodes[a]
+            n = self.node(var, self.union(lo, b), hi)
+        elif self.before(b, a):
+            var, lo, hi = self.nodes[b]
+            n = self.node(var, self.union(a, lo), hi)
+        else:
+            var, alo, ahi = self.nodes[a]
+            _, blo, bhi = self.nodes[b]
+            n = self.node(var, self.union(alo, blo), self.union(ahi, bhi))
+
+        self.cache[key] = n
+        return n
+
+    def join(self, a, b):
+        ## Every union of one set from each family (the "+" of a module definition)
+        if a == self.EMPTY or b == self.EMPTY:
+            return self.EMPTY
+        if a == self.BASE:
+            return b
+        if b == self.BASE:
+            return a
+        if a > b:
+            a, b = b, a
+        key = ("join", a, b)
+        if key in self.cache:
+            return self.cache[key]
+
+        if self.before(a, b):
+            var, lo, hi = self.nodes[a]
+            n = self.node(var, self.join(lo, b), self.join(hi, b))
+        elif self.before(b, a):
+            var, lo, hi = self.nodes[b]
+            n = self.node(var, self.join(a, lo), self.join(a, hi))
+        else:
+            var, alo, ahi = self.nodes[a]
+            _, blo, bhi = self.nodes[b]
+            hi = self.union(self.join(ahi, bhi), self.union(self.join(ahi, blo), self.join(alo, bhi)))
+            n = self.node(var, self.join(alo, blo), hi)
+
+        self.cache[key] = n
+        return n
+
+    def without_empty(self, a):
+        ## Same family minus the empty set
+        if a <= self.BASE:
+            return self.EMPTY
+        var, lo, hi = self.nodes[a]
+        return self.node(var, self.without_empty(lo), hi)
+
+    ##########################################
+    ## Queries
+    ##########################################
+    def count(self, a):
+        ## Number of sets in the family, without enumerating them
+        if a <= self.BASE:
+            return a
+        key = ("count", a)
+        if key not in self.cache:
+            var, lo, hi = self.nodes[a]
+            self.cache[key] = self.count(lo) + self.count(hi)
+        return self.cache[key]
+
+    def contains(self, a, kos):
+        ## True if `kos` is one of the sets in the family
+        items = sorted(set(kos))
+        i = 0
+        while a > self.BASE:
+            var, lo, hi = self.nodes[a]
+            if i < len(items) and items[i] == var:
+                a = hi
+                i += 1
+            elif i < len(items) and items[i] < var:
+                return False ## No set below this node has items[i]
+            else:
+                a = lo
+        return a == self.BASE and i == len(items)
+
+    def subsets_of(self, a, kos):
+        ## Sub-family of sets contained in `kos`, e.g. the sets a genome's KOs fully cover
+        kos = set(kos)
+        memo = dict()
+        def restrict(n):
+            if n <= self.BASE:
+                return n
+            if n not in memo:
+                var, lo, hi = self.nodes[n]
+                if var in kos:
+                    memo[n] = self.node(var, restrict(lo), restrict(hi))
+                else:
+                    memo[n] = restrict(lo)
+            return memo[n]
+        return restrict(a)
+
+    def supersets_of(self, a, kos):
+        ## Sub-family of sets containing all of `kos`
+        items = sorted(set(kos))
+        memo = dict()
+        def restrict(n, i):
+            if i == len(items):
+                return n
+            if n <= self.BASE:
+                return self.EMPTY
+            if (n, i) not in memo:
+                var, lo, hi = self.nodes[n]
+                if var < items[i]:
+                    memo[(n, i)] = self.node(var, restrict(lo, i), restrict(hi, i))
+                elif var == items[i]:
+                    memo[(n, i)] = self.node(var, self.EMPTY, restrict(hi, i+1))
+                else:
+                    memo[(n, i)] = self.EMPTY
+            return memo[(n, i)]
+        return restrict(a, 0)
+
+    def iter_sets(self, a):
+        ## Enumerates the family's sets as frozensets
+        stack = [(a, ())]
+        while stack:
+            n, path = stack.pop()
+            if n == self.BASE:
+                yield frozenset(path)
+            elif n > self.BASE:
+                var, lo, hi = self.nodes[n]
+                stack.append((lo, path))
+                stack.append((hi, path + (var,)))
+
+    def to_sets(self, a):
+        return set(self.iter_sets(a))